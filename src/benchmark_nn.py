@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+'''
+Scaling benchmark for NNWrapper(data_parallel=True) on CPU.
+
+Each device count runs in its own process, since XLA_FLAGS (which sets the number of host
+devices) is only read when jax is first imported. Run from src/, e.g.
+    python benchmark_nn.py --devices 1,2,4,8 --n 200000
+'''
+
+def run_worker(n, d, batch_size, num_epochs, data_parallel):
+    # imported here so the parent process never initialises jax
+    import numpy as np
+    import jax
+    from nn import get_nn
+
+    rng = np.random.RandomState(0)
+    X = rng.randn(n, d).astype(np.float32)
+    y = (rng.rand(n) < 0.1).astype(np.float32)
+
+    model = get_nn(num_epochs=num_epochs, batch_size=batch_size, data_parallel=data_parallel)
+    data = model.to_device(X, y)
+
+    # warm up so compilation is not counted
+    model.run_epochs(data, num_epochs=num_epochs)[1].block_until_ready()
+    start = time.perf_counter()
+    model.run_epochs(data, num_epochs=num_epochs)[1].block_until_ready()
+    elapsed = time.perf_counter() - start
+
+    return {'devices': jax.device_count(), 'time': elapsed, 'rows_per_s': n*num_epochs / elapsed}
+
+def benchmark_data_parallel(device_counts=(1, 2, 4, 8), n=200000, d=50, batch_size=512, num_epochs=2):
+    '''Times fit epochs for each number of host devices. Returns a list of dicts.'''
+    results = []
+    for n_devices in device_counts:
+        env = dict(os.environ, XLA_FLAGS=f"--xla_force_host_platform_device_count={n_devices}")
+        out = subprocess.run(
+            [sys.executable, __file__, '--worker', '--n', str(n), '--d', str(d),
+             '--batch_size', str(batch_size), '--num_epochs', str(num_epochs), '--data_parallel', str(int(n_devices > 1))],
+            env=env, capture_output=True, text=True, check=True,
+        )
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=str, help='Comma separated numbers of host devices to compare', default='1,2,4,8')
+    parser.add_argument('--n', type=int, help='Number of rows in the synthetic training set', default=200000)
+    parser.add_argument('--d', type=int, help='Number of features in the synthetic training set', default=50)
+    parser.add_argument('--batch_size', type=int, help='Batch size (must be divisible by every device count)', default=512)
+    parser.add_argument('--num_epochs', type=int, help='Number of epochs per timed run', default=2)
+    parser.add_argument('--data_parallel', type=int, help='(worker only) shard batches across devices', default=1)
+    parser.add_argument('--worker', action='store_true', help='Run a single timing in this process and print it as json')
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.n, args.d, args.batch_size, args.num_epochs, bool(args.data_parallel))))
+    else:
+        results = benchmark_data_parallel([int(c) for c in args.devices.split(',')], n=args.n, d=args.d,
+                                          batch_size=args.batch_size, num_epochs=args.num_epochs)
+        print(f"{'devices':>8} {'time (s)':>10} {'rows/s':>12} {'speedup':>8}")
+        for r in results:
+            print(f"{r['devices']:>8} {r['time']:>10.3f} {r['rows_per_s']:>12.0f} {results[0]['time'] / r['time']:>8.2f}")
@@ -0,0 +1,71 @@
+import time
+import argparse
+import numpy as np
+import jax.numpy as jnp
+from query import mean_similarity, top_k
+
+'''
+Benchmarks for the query strategies in query.py.
+
+Run from src/, e.g.
+    python benchmark_query.py --n 20000 --similarity euclidean
+'''
+
+def _time(fn, *args, **kwargs):
+    # warm up so jit compilation is not counted
+    np.asarray(fn(*args, **kwargs))
+    start = time.perf_counter()
+    out = np.asarray(fn(*args, **kwargs))
+    return out, time.perf_counter() - start
+
+def benchmark_representativeness(X, similarity='euclidean', sigma=1.0, approxes=('random', 'kmeans', 'nystrom'), n_landmarks=(100, 1000)):
+    '''
+    Compares the landmark approximations of mean_similarity against the exact computation.
+    Returns a list of dicts with the runtime and relative error of each setting.
+    '''
+    exact, exact_time = _time(mean_similarity, X, sigma=sigma, similarity=similarity)
+    results = [{'approx': 'exact', 'n_landmarks': X.shape[0], 'time': exact_time, 'max_rel_err': 0.0, 'mean_rel_err': 0.0}]
+
+    for approx in approxes:
+        for m in n_landmarks:
+            estimate, approx_time = _time(mean_similarity, X, sigma=sigma, similarity=similarity, approx=approx, n_landmarks=m)
+            rel_err = np.abs(estimate - exact) / np.abs(exact)
+            results.append({'approx': approx, 'n_landmarks': m, 'time': approx_time,
+                            'max_rel_err': rel_err.max(), 'mean_rel_err': rel_err.mean()})
+
+    return results
+
+def benchmark_top_k(pool_sizes=(10**4, 10**5, 10**6), K=100, repeats=5):
+    '''
+    Compares top_k against the full argsort it replaced for selecting K of n scores.
+    Returns a list of dicts with the mean runtime of each.
+    '''
+    results = []
+    for n in pool_sizes:
+        scores = jnp.asarray(np.random.RandomState(0).rand(n).astype(np.float32))
+        result = {'n': n}
+        for name, fn in [('argsort', lambda s: jnp.argsort(-s)[:K]), ('top_k', lambda s: top_k(s, K))]:
+            result[name] = np.mean([_time(fn, scores)[1] for _ in range(repeats)])
+        results.append(result)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, help='Number of rows in the synthetic pool', default=20000)
+    parser.add_argument('--d', type=int, help='Number of features in the synthetic pool', default=50)
+    parser.add_argument('--similarity', type=str, help='Similarity to benchmark (euclidean or rbf)', default='euclidean')
+    parser.add_argument('--sigma', type=float, help='RBF scaling parameter', default=10.0)
+    parser.add_argument('--K', type=int, help='Number of samples selected in the top-K benchmark', default=100)
+    args = parser.parse_args()
+
+    X = np.random.RandomState(0).randn(args.n, args.d).astype(np.float32)
+
+    print(f"Representativeness ({args.similarity}), n={args.n}, d={args.d}")
+    print(f"{'approx':>8} {'landmarks':>10} {'time (s)':>10} {'max rel err':>12} {'mean rel err':>13}")
+    for r in benchmark_representativeness(X, similarity=args.similarity, sigma=args.sigma):
+        print(f"{r['approx']:>8} {r['n_landmarks']:>10} {r['time']:>10.3f} {r['max_rel_err']:>12.2e} {r['mean_rel_err']:>13.2e}")
+
+    print(f"\nTop-{args.K} selection")
+    print(f"{'n':>8} {'argsort (s)':>12} {'top_k (s)':>10} {'speedup':>8}")
+    for r in benchmark_top_k(K=args.K):
+        print(f"{r['n']:>8} {r['argsort']:>12.5f} {r['top_k']:>10.5f} {r['argsort'] / r['top_k']:>8.1f}")
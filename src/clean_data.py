@@ -1,117 +1,95 @@
 import matplotlib.pyplot as plt
 from numpy import  *
+import numpy as np
 import pandas as pd
+import os
+import json
+import tempfile
 
 import pylab as pl
 from IPython import display
 
-def normalize(base):
-    # # base = pd.read_csv('archive/Variant I.csv')
-    # # remove 'income', 'customer_age', 'employment_status' columns as they are protected
-    # base = base.drop(columns=['income', 'customer_age', 'employment_status'])
-    
-    
-    # # convert categorical variables in 'payment_type' to integers
-    # base['payment_type'] = base['payment_type'].astype('category')
-    # base['housing_status'] = base['housing_status'].astype('category')
-    # base['source'] = base['source'].astype('category')
-    # base['device_os'] = base['device_os'].astype('category')
-
-    # cat_columns = base.select_dtypes(['category']).columns
-    # base[cat_columns] = base[cat_columns].apply(lambda x: x.cat.codes)
-
-    # base_pd = base
-
-    missing_value = -10 # missing values are replaced by this!
-
-    def mean_std_scale(x): return (x - x.mean())/x.std()
-
-    df = base.copy()
-
-    # df = pd.DataFrame(index=range(len(base)), columns=[])
-    # df['fraud_bool'] = base['fraud_bool'].copy().astype(float)
-    # df['name_email_similarity'] = base['name_email_similarity'].copy()
-
-    ## scale
-    prev = base['prev_address_months_count'].copy().astype(float)
-    prev[prev > 0] = (prev[prev > 0] / prev.max()).copy()
-    prev[prev < 0] = missing_value
-    df['prev_address_months_count'] = prev.copy()
-
-    prev = base['current_address_months_count'].copy().astype(float)
-    prev[prev > 0] = (prev[prev > 0] / prev.max()).copy()
-    prev[prev < 0] = missing_value
-    df['current_address_months_count'] = prev.copy()
-
-    df['days_since_request'] = mean_std_scale(base['days_since_request']).copy()
-    df['intended_balcon_amount'] = mean_std_scale(base['intended_balcon_amount']).copy()
-
-    # pt = pd.get_dummies(base, columns=['payment_type'])
-    # for i in range(5): df[f'payment_type_{i}'] = pt[f'payment_type_{i}'].astype(float)
-
-
-    df['zip_count_4w'] = mean_std_scale(base['zip_count_4w'].copy().astype(float))
-
-    ## not sure these should be mean/std scaled tbh... maybe min/max scaling would be better
-    ## https://www.dropbox.com/scl/fo/vg4b2hyapa9o9ajanbfl3/AL1RUfD1rAb5RBvgFQwc8eI/bank-account-fraud/documents?dl=0&preview=datasheet.pdf&rlkey=2r99po055q5pjbg1934ga0c8i&subfolder_nav_tracking=1
-    for col in ['velocity_6h', 'velocity_24h', 'velocity_4w',
-                'bank_branch_count_8w', 'date_of_birth_distinct_emails_4w',
-                'credit_risk_score']:
-        df[col] = mean_std_scale(base[col]).copy()
-
-    # df['email_is_free'] = base['email_is_free'].copy().astype(float)
-
-
-    # pt = pd.get_dummies(base, columns=['housing_status'])
-    # for i in range(7): df[f'housing_status_{i}'] = pt[f'housing_status_{i}'].astype(float)
-
-    # df['phone_home_valid'] = base['phone_home_valid'].copy().astype(float)
-    # df['phone_mobile_valid'] = base['phone_mobile_valid'].copy().astype(float)
+MISSING_VALUE = -10 # missing values are replaced by this!
+
+# columns divided by their max, negative values mark a missing value
+MAX_SCALE_COLUMNS = ['prev_address_months_count', 'current_address_months_count',
+                     'session_length_in_minutes', 'device_distinct_emails_8w']
+
+## not sure these should be mean/std scaled tbh... maybe min/max scaling would be better
+## https://www.dropbox.com/scl/fo/vg4b2hyapa9o9ajanbfl3/AL1RUfD1rAb5RBvgFQwc8eI/bank-account-fraud/documents?dl=0&preview=datasheet.pdf&rlkey=2r99po055q5pjbg1934ga0c8i&subfolder_nav_tracking=1
+MEAN_STD_COLUMNS = ['days_since_request', 'intended_balcon_amount', 'zip_count_4w',
+                    'velocity_6h', 'velocity_24h', 'velocity_4w',
+                    'bank_branch_count_8w', 'date_of_birth_distinct_emails_4w',
+                    'credit_risk_score', 'proposed_credit_limit']
+
+# columns only cast to float
+FLOAT_COLUMNS = ['device_fraud_count']
+
+class Normalizer():
+    '''
+    Learns the scaling statistics once (normally from the training split) and applies
+    the same float32 transform to any split, chunk or batch of rows.
+    '''
+    def __init__(self):
+        self.columns = []
+        self.is_max_scaled = np.zeros(0, dtype=bool)
+        self.shift = np.zeros(0, dtype=np.float32)
+        self.scale = np.ones(0, dtype=np.float32)
+
+    def fit(self, df):
+        '''Learns the max of MAX_SCALE_COLUMNS and the mean/std of MEAN_STD_COLUMNS.'''
+        max_cols = [c for c in MAX_SCALE_COLUMNS if c in df.columns]
+        std_cols = [c for c in MEAN_STD_COLUMNS if c in df.columns]
+        float_cols = [c for c in FLOAT_COLUMNS if c in df.columns]
+
+        self.columns = max_cols + std_cols + float_cols
+        self.is_max_scaled = np.array([c in max_cols for c in self.columns], dtype=bool)
+        # x -> (x - shift) / scale for the mean/std and float columns
+        self.shift = np.concatenate([np.zeros(len(max_cols)), df[std_cols].mean().to_numpy(), np.zeros(len(float_cols))]).astype(np.float32)
+        self.scale = np.concatenate([df[max_cols].max().to_numpy(), df[std_cols].std().to_numpy(), np.ones(len(float_cols))]).astype(np.float32)
+        return self
+
+    def transform_array(self, X):
+        '''Transforms a 2D array whose columns are self.columns, returning float32.'''
+        X = np.asarray(X, dtype=np.float32)
+        scaled = (X - self.shift) / self.scale
+        missing = self.is_max_scaled & (X < 0)
+        unscaled = self.is_max_scaled & (X == 0)
+        return np.where(missing, np.float32(MISSING_VALUE), np.where(unscaled, X, scaled))
+
+    def transform(self, df):
+        '''Returns a copy of df with the fitted columns transformed.'''
+        transformed = self.transform_array(df[self.columns].to_numpy(dtype=np.float32))
+        return df.assign(**{col: transformed[:, i] for i, col in enumerate(self.columns)})
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def save(self, path):
+        # written to a temporary file and swapped in, so jobs sharing a data dir never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'columns': self.columns, 'is_max_scaled': self.is_max_scaled.tolist(),
+                       'shift': self.shift.tolist(), 'scale': self.scale.tolist()}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            state = json.load(f)
+        normalizer = cls()
+        normalizer.columns = state['columns']
+        normalizer.is_max_scaled = np.array(state['is_max_scaled'], dtype=bool)
+        normalizer.shift = np.array(state['shift'], dtype=np.float32)
+        normalizer.scale = np.array(state['scale'], dtype=np.float32)
+        return normalizer
 
-
-    # prev = base['bank_months_count'].copy().astype(float)
-    # prev[prev > 0] = (prev[prev > 0] / prev.max()).copy()
-    # prev[prev < 0] = missing_value
-    # df['bank_months_count'] = prev.copy()
-
-    # df['has_other_cards'] = base['has_other_cards'].copy().astype(float)
-    # df['foreign_request'] = base['foreign_request'].copy().astype(float)
-
-
-    ## not sure these should be mean/std scaled tbh... maybe min/max scaling would be better
-    ## https://www.dropbox.com/scl/fo/vg4b2hyapa9o9ajanbfl3/AL1RUfD1rAb5RBvgFQwc8eI/bank-account-fraud/documents?dl=0&preview=datasheet.pdf&rlkey=2r99po055q5pjbg1934ga0c8i&subfolder_nav_tracking=1
-    for col in ['proposed_credit_limit']:
-        df[col] = mean_std_scale(base[col]).copy()
-
-
-    # df['source'] = base['source'].copy().astype(float)
-
-    prev = base['session_length_in_minutes'].copy().astype(float)
-    prev[prev > 0] = (prev[prev > 0] / prev.max()).copy()
-    prev[prev < 0] = missing_value
-    df['session_length_in_minutes'] = prev.copy()
-
-
-    # pt = pd.get_dummies(base, columns=['device_os'])
-    # for i in range(5): df[f'device_os_{i}'] = pt[f'device_os_{i}'].astype(float)
-
-    # df['keep_alive_session'] = base['keep_alive_session'].copy().astype(float)
-
-    prev = base['device_distinct_emails_8w'].copy().astype(float)
-    prev[prev > 0] = (prev[prev > 0] / prev.max()).copy()
-    prev[prev < 0] = missing_value
-    df['device_distinct_emails_8w'] = prev.copy()
-
-    df['device_fraud_count'] = base['device_fraud_count'].copy().astype(float)
-
-    # pt = pd.get_dummies(base, columns=['month'])
-    # for i in range(8): df[f'month_{i}'] = pt[f'month_{i}'].astype(float)
-
-    # base = base.to_numpy()
-
-    # base = df.to_numpy()
-
-    return df
+def normalize(base):
+    '''
+    Normalizes a single frame using its own statistics.
+    Prefer fitting a Normalizer on the training split and transforming every split with it.
+    '''
+    return Normalizer().fit_transform(base)
 
 # from sklearn.model_selection import train_test_split
 
@@ -15,6 +15,10 @@ export EXE=/bin/hostname
 # module load your_module
 # export YOUR_VARIABLE=value
 
+# Optional: expose each CPU core as a separate XLA device, for neural nets run with --data_parallel=1
+# (the batch size must be divisible by the number of devices)
+# export XLA_FLAGS="--xla_force_host_platform_device_count=${SLURM_CPUS_PER_TASK}"
+
 # Change to your working directory
 cd "${SLURM_SUBMIT_DIR}"
 
@@ -13,9 +13,9 @@ use_harrys_data = True
 
 # If running labelled_exp
 def labelled_exp(saver, **config):
-    check_preprocessed()
+    check_preprocessed(harry=use_harrys_data)
     # Get and prepare the data
-    train_data, test_data, validate_data = get_data(normalize_data=True, harry=use_harrys_data)
+    train_data, test_data, validate_data = get_data(normalize_data=True, harry=use_harrys_data, variant=config['label_variant'] or None)
     X_train, y_train = get_X_y_labelled(train_data)
     # X_val, y_val = get_X_y_labelled(validate_data) Not currently using validation data
     X_test, y_test = get_X_y_labelled(test_data)
@@ -27,7 +27,8 @@ def labelled_exp(saver, **config):
 
     # Get the model
     if config['model'] == 'xgboost':
-        model = get_xgb(lr=config['learning_rate'], n_estimators=config['n_estimators'], max_depth=config['max_depth'])
+        model = get_xgb(lr=config['learning_rate'], n_estimators=config['n_estimators'], max_depth=config['max_depth'], update_mode=config['update_mode'], update_trees=config['update_trees'], max_trees=config['max_trees'],
+                        tree_method=config['tree_method'], max_bin=config['max_bin'], nthread=config['nthread'] or None, subsample=config['subsample'], sampling_method=config['sampling_method'], external_memory=bool(config['external_memory']))
     elif config['model'] == 'neural_net':
         model = get_nn(
             lr=config['learning_rate'], 
@@ -38,6 +39,7 @@ def labelled_exp(saver, **config):
             # update_ratio=config['update_ratio'],
             num_update_epochs=config['num_update_epochs'],
             MLP_shape=config['MLP_shape'],
+            data_parallel=bool(config['data_parallel']),
             )
     else:
         raise ValueError("Model not recognized.")
@@ -60,9 +62,9 @@ def labelled_exp(saver, **config):
 
 # If running missing_labels_exp
 def missing_labels_exp(saver, **config):
-    check_preprocessed()
+    check_preprocessed(harry=use_harrys_data)
     # Get and prepare the data
-    train_data, test_data, validate_data = get_data(normalize_data=True, harry=use_harrys_data)
+    train_data, test_data, validate_data = get_data(normalize_data=True, harry=use_harrys_data, variant=config['label_variant'] or None)
     X, y = get_X_y_labelled(train_data)
     X_test, y_test = get_X_y_labelled(test_data)
 
@@ -77,7 +79,8 @@ def missing_labels_exp(saver, **config):
 
     # Get the model
     if config['model'] == 'xgboost':
-        model = get_xgb(lr=config['learning_rate'], n_estimators=config['n_estimators'], max_depth=config['max_depth'])
+        model = get_xgb(lr=config['learning_rate'], n_estimators=config['n_estimators'], max_depth=config['max_depth'], update_mode=config['update_mode'], update_trees=config['update_trees'], max_trees=config['max_trees'],
+                        tree_method=config['tree_method'], max_bin=config['max_bin'], nthread=config['nthread'] or None, subsample=config['subsample'], sampling_method=config['sampling_method'], external_memory=bool(config['external_memory']))
     elif config['model'] == 'neural_net':
         model = get_nn(
             lr=config['learning_rate'], 
@@ -88,6 +91,7 @@ def missing_labels_exp(saver, **config):
             # update_ratio=config['update_ratio'],
             num_update_epochs=config['num_update_epochs'],
             MLP_shape=config['MLP_shape'],
+            data_parallel=bool(config['data_parallel']),
             )
     else:
         raise ValueError("Model not recognized.")
@@ -103,7 +107,8 @@ def missing_labels_exp(saver, **config):
 
 def list_to_dict(g):
     def split_at_equals(s):
-        return s.split('=')
+        # only the first '=', values such as label variant keys contain more
+        return s.split('=', 1)
     
     def maybe_convert_to_numeric(s):
         try:
@@ -132,6 +137,17 @@ if  __name__ == "__main__":
     parser.add_argument('--loss', type=str, help='Loss function to use', default="logloss")
     parser.add_argument('--num_update_epochs', type=int, help='Number of update epochs to run', default=10)
     parser.add_argument('--MLP_shape', type=str, help='Shape of the MLP', default="128,128")
+    parser.add_argument('--update_mode', type=str, help='How xgboost updates on new data (append, fixed, refresh or cap)', default="append")
+    parser.add_argument('--update_trees', type=int, help='Trees added per xgboost update in the fixed and cap modes', default=10)
+    parser.add_argument('--max_trees', type=int, help='Maximum xgboost ensemble size in the cap mode', default=1000)
+    parser.add_argument('--tree_method', type=str, help='XGBoost tree method', default="hist")
+    parser.add_argument('--max_bin', type=int, help='Maximum number of histogram bins per feature in xgboost', default=256)
+    parser.add_argument('--nthread', type=int, help='Threads per xgboost model (0 uses SLURM_CPUS_PER_TASK or all cores)', default=0)
+    parser.add_argument('--subsample', type=float, help='Fraction of rows sampled per xgboost tree', default=1.0)
+    parser.add_argument('--sampling_method', type=str, help='XGBoost row sampling method (uniform or gradient_based)', default="uniform")
+    parser.add_argument('--external_memory', type=int, help='Train xgboost from external memory (1) or in memory (0)', default=0)
+    parser.add_argument('--label_variant', type=str, help='Key of a label variant written by preprocess.py (default: the labels the splits were written with)', default="")
+    parser.add_argument('--data_parallel', type=int, help='Split NN batches across all XLA devices (1) or not (0)', default=0)
     parser.add_argument('--query_method', type=str, help='Query method to use', default="")
     parser.add_argument('--query_K', type=int, help='Number of samples to query', default=10)
     parser.add_argument('--query_alpha', type=float, help='Alpha for query method', default=0.1)
@@ -152,6 +168,17 @@ if  __name__ == "__main__":
         'update_ratio': [args.update_ratio],
         'num_update_epochs': [args.num_update_epochs],
         'MLP_shape': [args.MLP_shape],
+        'data_parallel': [args.data_parallel],
+        'label_variant': [args.label_variant],
+        'update_mode': [args.update_mode],
+        'update_trees': [args.update_trees],
+        'max_trees': [args.max_trees],
+        'tree_method': [args.tree_method],
+        'max_bin': [args.max_bin],
+        'nthread': [args.nthread],
+        'subsample': [args.subsample],
+        'sampling_method': [args.sampling_method],
+        'external_memory': [args.external_memory],
         'query_method': [args.query_method],
         'query_K': [args.query_K],
         'query_alpha': [args.query_alpha],
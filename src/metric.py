@@ -1,5 +1,7 @@
 from sklearn.metrics import roc_auc_score, precision_recall_curve, roc_curve, average_precision_score
 import numpy as np
+import jax
+import jax.numpy as jnp
 import wandb
 
 
@@ -9,11 +11,33 @@ def recall_at_5_fpr(y_true, y_probs):
     idx = np.argmax(fpr >= 0.05)
     return tpr[idx]
 
+confusion_names = ['tn', 'fp', 'fn', 'tp']
+
+def _confusion_bins(xp, y_true, y_probs, threshold):
+    # bin 2*label + prediction, i.e. tn, fp, fn, tp; labels other than 0/1 go to an ignored 5th bin
+    bins = 2*(y_true == 1) + (y_probs >= threshold)
+    return xp.where((y_true == 0) | (y_true == 1), bins, 4)
+
+@jax.jit
+def _confusion_counts_jax(y_true, y_probs, threshold):
+    return jnp.bincount(_confusion_bins(jnp, y_true, y_probs, threshold), length=5)[:4]
+
+def confusion_counts(y_true, y_probs, threshold=0.5):
+    '''
+    tp, tn, fp and fn at the threshold in one vectorised pass, as a dict of python ints.
+    Stays on device (one transfer of 4 counts) if either input is a jax array.
+    '''
+    if isinstance(y_true, jax.Array) or isinstance(y_probs, jax.Array):
+        counts = jax.device_get(_confusion_counts_jax(jnp.asarray(y_true), jnp.ravel(jnp.asarray(y_probs)), threshold))
+    else:
+        counts = np.bincount(_confusion_bins(np, np.asarray(y_true), np.ravel(y_probs), threshold), minlength=5)[:4]
+    return {name: int(count) for name, count in zip(confusion_names, counts)}
+
 metric_name2func = {
-    'tp': lambda y_true, y_probs: sum((y_true == 1) & (y_probs >= 0.5)),
-    'tn': lambda y_true, y_probs: sum((y_true == 0) & (y_probs < 0.5)),
-    'fp': lambda y_true, y_probs: sum((y_true == 0) & (y_probs >= 0.5)),
-    'fn': lambda y_true, y_probs: sum((y_true == 1) & (y_probs < 0.5)),
+    'tp': lambda y_true, y_probs: confusion_counts(y_true, y_probs)['tp'],
+    'tn': lambda y_true, y_probs: confusion_counts(y_true, y_probs)['tn'],
+    'fp': lambda y_true, y_probs: confusion_counts(y_true, y_probs)['fp'],
+    'fn': lambda y_true, y_probs: confusion_counts(y_true, y_probs)['fn'],
     'auc': lambda y_true, y_probs: roc_auc_score(y_true, y_probs) if len(np.unique(y_true)) > 1 else 0,
     'aucpr': average_precision_score,
     'rec@5fpr': recall_at_5_fpr,
@@ -64,10 +88,21 @@ class MetricStore():
     def calculate_metrics(self, y_true, y_probs, set_name):
         '''Calculate the metrics for the given data'''
         metrics = {metric_name: {} for metric_name in self.metric_names}
+
+        # the four confusion counts come from one pass over the data
+        if any(metric_name in confusion_names for metric_name in self.metric_names):
+            counts = confusion_counts(y_true, y_probs)
+
+        # the remaining (sklearn) metrics work on host arrays, so fetch them once rather than per metric
+        y_true, y_probs = np.asarray(y_true), np.asarray(y_probs)
+
         for metric_name in self.metric_names:
             if metric_name == 'loss':
                 continue
-            metrics[metric_name][set_name] = metric_name2func[metric_name](y_true, y_probs)
+            if metric_name in confusion_names:
+                metrics[metric_name][set_name] = counts[metric_name]
+            else:
+                metrics[metric_name][set_name] = metric_name2func[metric_name](y_true, y_probs)
 
         self.log(metrics)
         return metrics
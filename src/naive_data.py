@@ -1,11 +1,12 @@
 import pandas as pd
+from preprocess import CategoryEncoder
 
 def naive_get_data(drop_portion_of_labels=0.9, reduce_size=0.2):
     card_df = pd.read_csv('./data/Base.csv')
     # Reduce the size of the dataset
     card_df = card_df.sample(n = 400000,random_state=42)
     # One hot encode
-    card_df = pd.get_dummies(card_df)
+    card_df = CategoryEncoder().fit(card_df).transform_frame(card_df)
     # Reduce the size of the dataset
     if reduce_size < 1:
         card_df = card_df.sample(frac=reduce_size, random_state=42)
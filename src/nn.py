@@ -3,10 +3,13 @@ import jax
 import jax.numpy as jnp
 import flax.linen as nn
 from  flax.training import train_state
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
 import optax
+from functools import partial
 from optax import adam, sgd
 from optax.losses import sigmoid_binary_cross_entropy
 from typing import Sequence
+from collections import Counter
 from sklearn.metrics import roc_auc_score, accuracy_score
 from metric import MetricStore
 
@@ -20,6 +23,19 @@ optimizers_str2fn = {
     'sgd': sgd
 }
 
+dtypes_str2dtype = {
+    'float32': None,
+    'bfloat16': jnp.bfloat16,
+    'float16': jnp.float16
+}
+
+# number of times each jitted function below has been traced (i.e. compiled), see get_compile_counts
+compile_counter = Counter()
+
+def get_compile_counts():
+    '''How many times each jitted function in this module has been traced so far.'''
+    return dict(compile_counter)
+
 def get_nn(**kwargs):
     return NNWrapper(**kwargs) # use default parameters unless otherwise specified
 
@@ -37,8 +53,40 @@ class MLP(nn.Module):
                 x = nn.relu(x)
         return x
 
+def masked_mean(values, mask):
+    '''Mean of values over the entries where mask is True (0 if there are none).'''
+    return jnp.sum(jnp.where(mask, values, 0)) / jnp.maximum(jnp.sum(mask), 1)
+
+def bucket_size(n, minimum=1):
+    '''Smallest power of two that is >= n (and >= minimum).'''
+    return max(1 << max(int(n) - 1, 0).bit_length(), minimum)
+
+def pad_to_batches(X, y, batch_size, bucket=False):
+    '''
+    Pads X and y with zero rows up to a whole number of batches and reshapes them to
+    (n_batches, batch_size, ...), so every step of an epoch sees the same shape.
+    With bucket, n_batches is also rounded up to a power of two, so inputs of slowly growing
+    size (e.g. the labelled set in train.train) only hit a handful of compiled shapes. That can
+    nearly double the batches, so it is only worth it for data whose size changes between calls.
+    Returns the batched X, y and a (n_batches, batch_size) mask of the real rows.
+    '''
+    n = X.shape[0]
+    n_batches = max(-(-n // batch_size), 1)
+    if bucket:
+        n_batches = bucket_size(n_batches)
+    pad = n_batches*batch_size - n
+
+    X = jnp.pad(jnp.asarray(X), ((0, pad), (0, 0)))
+    y = jnp.pad(jnp.asarray(y), (0, pad))
+    mask = jnp.arange(n_batches*batch_size) < n
+
+    return X.reshape(n_batches, batch_size, -1), y.reshape(n_batches, batch_size), mask.reshape(n_batches, batch_size)
+
 @jax.jit
-def train_step(state, X_batch, y_batch):
+def train_step(state, X_batch, y_batch, mask=None):
+    compile_counter['train_step'] += 1
+    if mask is None:
+        mask = jnp.ones(y_batch.shape, dtype=bool)
 
     def upweight_positive_loss(loss_val, factor=2):
         return jnp.where(y_batch == 1, factor*loss_val, loss_val)
@@ -47,7 +95,7 @@ def train_step(state, X_batch, y_batch):
         logits = state.apply_fn(params, X_batch).flatten()
 
         # return loss_fn(logits, y_batch)
-        return jnp.mean(upweight_positive_loss(sigmoid_binary_cross_entropy(logits, y_batch))), logits
+        return masked_mean(upweight_positive_loss(sigmoid_binary_cross_entropy(logits, y_batch)), mask), logits
         # return jnp.mean(sigmoid_binary_cross_entropy(logits, y_batch)), logits
     
     loss_grad_fn = jax.value_and_grad(loss, has_aux=True)
@@ -62,16 +110,128 @@ def train_step(state, X_batch, y_batch):
 
     return state, loss_val, logits
 
+@partial(jax.jit, static_argnames=['num_epochs'])
+def train_epochs(state, X_batches, y_batches, mask, num_epochs=1):
+    '''
+    Runs num_epochs epochs over the padded batches (see pad_to_batches) entirely on device,
+    as a lax.scan over epochs of a lax.scan over batches.
+    Batches with no real rows (bucket padding) leave the state untouched, so the optimizer
+    does not take extra steps on them.
+    Returns the new state, and the mean loss and (padded, flattened) logits of the last epoch.
+    '''
+    compile_counter['train_epochs'] += 1
+
+    def batch_step(state, batch):
+        X_batch, y_batch, mask_batch = batch
+
+        def skip(state):
+            return state, jnp.zeros((), dtype=jnp.float32), jnp.zeros(y_batch.shape, dtype=jnp.float32)
+
+        state, loss_val, logits = jax.lax.cond(
+            jnp.any(mask_batch), lambda state: train_step(state, X_batch, y_batch, mask_batch), skip, state
+        )
+        return state, (loss_val*jnp.sum(mask_batch), logits)
+
+    def epoch_step(state, _):
+        state, (batch_losses, logits) = jax.lax.scan(batch_step, state, (X_batches, y_batches, mask))
+        return state, (jnp.sum(batch_losses) / jnp.sum(mask), logits.reshape(-1))
+
+    state, (losses, logits) = jax.lax.scan(epoch_step, state, None, length=num_epochs)
+    return state, losses[-1], logits[-1]
+
+@partial(jax.jit, static_argnames=['num_epochs'])
+def train_epochs_shuffled(state, key, X_batches, y_batches, mask, num_epochs=1):
+    '''
+    train_epochs on a random permutation of the rows, drawn on device with jax.random.
+    Padding rows are sorted last so they stay in whole trailing batches.
+    The returned logits are in the original row order.
+    '''
+    compile_counter['train_epochs_shuffled'] += 1
+
+    n_rows = mask.size
+    u = jnp.where(mask.reshape(-1), jax.random.uniform(key, (n_rows,)), 2.0)
+    perm = jnp.argsort(u)
+
+    X_batches = X_batches.reshape(n_rows, -1)[perm].reshape(X_batches.shape)
+    y_batches = y_batches.reshape(-1)[perm].reshape(y_batches.shape)
+    mask = mask.reshape(-1)[perm].reshape(mask.shape)
+
+    state, loss_val, logits = train_epochs(state, X_batches, y_batches, mask, num_epochs=num_epochs)
+    return state, loss_val, jnp.zeros_like(logits).at[perm].set(logits)
+
 @jax.jit
-def eval_step(state, X_batch, y_batch):
+def eval_step(state, X_batch, y_batch, mask=None):
+    compile_counter['eval_step'] += 1
+    if mask is None:
+        mask = jnp.ones(y_batch.shape, dtype=bool)
+
     logits = state.apply_fn(state.params, X_batch).flatten()
-    loss_val = jnp.mean(sigmoid_binary_cross_entropy(logits, y_batch))
+    loss_val = masked_mean(sigmoid_binary_cross_entropy(logits, y_batch), mask)
 
     return loss_val, logits
 
+@jax.jit
+def eval_epoch(state, X_batches, y_batches, mask):
+    '''
+    Evaluates the padded batches (see pad_to_batches) in one lax.map. Returns the mean loss and padded logits.
+    Batches with no real rows (bucket padding) are skipped, as in train_epochs.
+    '''
+    compile_counter['eval_epoch'] += 1
+
+    def eval_batch(batch):
+        X_batch, y_batch, mask_batch = batch
+
+        def skip(_):
+            return jnp.zeros((), dtype=jnp.float32), jnp.zeros(y_batch.shape, dtype=jnp.float32)
+
+        return jax.lax.cond(jnp.any(mask_batch), lambda _: eval_step(state, X_batch, y_batch, mask_batch), skip, None)
+
+    losses, logits = jax.lax.map(eval_batch, (X_batches, y_batches, mask))
+    return jnp.sum(losses*jnp.sum(mask, axis=1)) / jnp.sum(mask), logits.reshape(-1)
+
+@partial(jax.jit, static_argnums=0, static_argnames=['dtype'])
+def predict_step(model, params, X, dtype=None):
+    '''
+    Predicted probabilities of the model for X (already padded to a bucket size by the caller).
+    dtype: optionally run the forward pass in lower precision (e.g. jnp.bfloat16); the
+           probabilities are always returned as float32.
+    '''
+    compile_counter['predict_step'] += 1
+    if dtype is not None:
+        params = jax.tree_util.tree_map(lambda p: p.astype(dtype), params)
+        X = X.astype(dtype)
+    return jax.nn.sigmoid(model.apply(params, X).astype(jnp.float32)).flatten()
+
+
+class DeviceDataset():
+    '''
+    X, y transferred to device once, already padded to batches of batch_size.
+    Pass it to NNWrapper.fit/update/validation instead of numpy arrays to avoid re-uploading
+    the same data; NNWrapper.to_device builds (and caches) these for you.
+    bucket: round the number of batches up to a power of two (see pad_to_batches), for data that grows
+    mesh: if given, every batch is split across the mesh's 'data' axis (see NNWrapper data_parallel)
+    '''
+    def __init__(self, X, y, batch_size:int, bucket=False, mesh=None):
+        self.n = X.shape[0]
+        self.batch_size = batch_size
+        self.bucket = bucket
+        self.X, self.y, self.mask = pad_to_batches(X, y, batch_size, bucket=bucket)
+        self.y_host = np.asarray(y)
+
+        if mesh is not None:
+            self.X = jax.device_put(self.X, NamedSharding(mesh, P(None, 'data', None)))
+            self.y = jax.device_put(self.y, NamedSharding(mesh, P(None, 'data')))
+            self.mask = jax.device_put(self.mask, NamedSharding(mesh, P(None, 'data')))
+
+    @property
+    def n_features(self):
+        return self.X.shape[-1]
+
+    def __len__(self):
+        return self.n
 
 class NNWrapper:
-    def __init__(self, lr=0.05, opt='adam', loss='cross_entropy', num_epochs=10, batch_size=512, num_update_epochs=10, MLP_shape='128,128'):
+    def __init__(self, lr=0.05, opt='adam', loss='cross_entropy', num_epochs=10, batch_size=512, num_update_epochs=10, MLP_shape='128,128', n_features=None, predict_chunk_size=2**14, predict_dtype='float32', shuffle_seed=0, device_cache_size=4, data_parallel=False):
         '''
         lr: learning rate
         opt: optimizer
@@ -79,6 +239,16 @@ class NNWrapper:
         num_epochs: number of epochs
         batch_size: batch size
         num_update_epochs: number of epochs to update
+        n_features: input width (e.g. CategoryEncoder.n_features minus any dropped columns);
+                    if None the parameters are initialised from the first X seen by fit/update
+        predict_chunk_size: number of rows predict scores per jitted call
+        predict_dtype: precision of the forward pass in predict ('float32', 'bfloat16' or 'float16')
+        shuffle_seed: seed of the on-device shuffling in update
+        device_cache_size: number of (X, y) pairs whose device copies are kept, see to_device
+        data_parallel: split every batch across all XLA devices (parameters are replicated and
+                       XLA all-reduces the gradients). On CPU, set
+                       XLA_FLAGS=--xla_force_host_platform_device_count=<n> before jax is imported
+                       to get n devices. batch_size must be divisible by the number of devices.
         '''
         
         self.lr = lr
@@ -88,15 +258,24 @@ class NNWrapper:
         self.num_epochs = num_epochs
         self.batch_size = batch_size
         self.num_update_epochs = num_update_epochs
-
-        MLP_shape = [51, *[int(w) for w in MLP_shape.split(',')],1]
-
-        self.model = MLP(features=MLP_shape)
-
-        self.params = self.model.init(jax.random.PRNGKey(0), jnp.ones((MLP_shape[0],)))
-        self.opt_state = self.opt.init(self.params)
-
-        self.state = train_state.TrainState.create(apply_fn=self.model.apply, params=self.params, tx=self.opt)
+        self.predict_chunk_size = predict_chunk_size
+        self.predict_dtype = predict_dtype
+        self.shuffle_key = jax.random.PRNGKey(shuffle_seed)
+        self.device_cache_size = device_cache_size
+        self._device_cache = []
+
+        self.mesh = None
+        if data_parallel:
+            n_devices = jax.device_count()
+            if batch_size % n_devices != 0:
+                raise ValueError(f"batch_size ({batch_size}) must be divisible by the number of devices ({n_devices}).")
+            self.mesh = Mesh(np.array(jax.devices()), ('data',))
+
+        self.hidden_shape = [int(w) for w in MLP_shape.split(',')]
+        self.n_features = None
+        self.state = None
+        if n_features is not None:
+            self.init_params(n_features)
 
         self.metric_store = MetricStore()
 
@@ -131,48 +310,70 @@ class NNWrapper:
                     
 
 
-    def one_epoch(self, X, y, final_epoch=False):
-        logits_collection = []
-        total_loss_val = 0
-        for i in range(0, X.shape[0], self.batch_size):
-            X_batch = X[i:i+self.batch_size]
-            y_batch = y[i:i+self.batch_size]
+    def init_params(self, n_features):
+        # the first layer is as wide as the input, as with the original hard-coded 51
+        MLP_shape = [n_features, *self.hidden_shape, 1]
 
-            # logits = self.model.apply(self.params, X_batch).flatten()
+        self.n_features = n_features
+        self.model = MLP(features=tuple(MLP_shape))
 
-            # make the batch have an equal number of positive and negative samples
-            # if y_batch.sum() > 0:
-            #     pos_idx = np.where(y_batch == 1)[0]
-            #     neg_idx = np.where(y_batch == 0)[0]
+        self.params = self.model.init(jax.random.PRNGKey(0), jnp.ones((n_features,)))
+        self.opt_state = self.opt.init(self.params)
 
-            #     if len(pos_idx) > len(neg_idx):
-            #         pos_idx = np.random.choice(pos_idx, len(neg_idx), replace=False)
-            #     elif len(neg_idx) > len(pos_idx):
-            #         neg_idx = np.random.choice(neg_idx, len(pos_idx), replace=False)
+        self.state = train_state.TrainState.create(apply_fn=self.model.apply, params=self.params, tx=self.opt)
+        if self.mesh is not None:
+            self.state = jax.device_put(self.state, NamedSharding(self.mesh, P()))
 
-            #     idx = np.concatenate((pos_idx, neg_idx))
-            #     X_batch = X_batch[idx, :]
-            #     y_batch = y_batch[idx]
+    def _check_params(self, data):
+        if self.state is None:
+            self.init_params(data.n_features)
+        elif data.n_features != self.n_features:
+            raise ValueError(f"Expected {self.n_features} features, got {data.n_features}.")
 
-            # loss_val, grads = self.loss_grad_fn(X_batch, y_batch)
+    def to_device(self, X, y=None, bucket=False):
+        '''
+        DeviceDataset for X, y. The last device_cache_size pairs are cached by identity, so
+        passing the same arrays again (e.g. the same eval_set every update) does not re-upload them.
+        bucket: pad to a power-of-two number of batches, for the growing training set of update
+        '''
+        if isinstance(X, DeviceDataset):
+            return X
 
-            self.state, loss_val, logits = train_step(self.state, X_batch, y_batch)
+        for i, (cached_X, cached_y, data) in enumerate(self._device_cache):
+            if cached_X is X and cached_y is y and data.bucket == bucket:
+                # most recently used first
+                self._device_cache.insert(0, self._device_cache.pop(i))
+                return data
 
-            logits_collection.append(logits)
-            total_loss_val += loss_val*X_batch.shape[0]
+        data = DeviceDataset(X, y, self.batch_size, bucket=bucket, mesh=self.mesh)
+        self._device_cache = [(X, y, data)] + self._device_cache[:self.device_cache_size-1]
+        return data
 
-        logits = jnp.concatenate(logits_collection, axis=0)
-        total_loss_val /= X.shape[0]
+    def run_epochs(self, X, y=None, num_epochs=1, shuffle=False):
+        '''
+        Trains for num_epochs epochs over X, y (arrays or a DeviceDataset) with one dispatch.
+        With shuffle the rows are permuted once, on device, before the epochs.
+        Returns the mean loss and logits (in the original row order) of the last epoch.
+        '''
+        data = self.to_device(X, y)
+        self._check_params(data)
 
-        return total_loss_val, logits
-        # self.update_metrics(total_loss_val, logits, y, 'training', final_epoch=final_epoch)
+        if shuffle:
+            self.shuffle_key, key = jax.random.split(self.shuffle_key)
+            self.state, total_loss_val, logits = train_epochs_shuffled(self.state, key, data.X, data.y, data.mask, num_epochs=num_epochs)
+        else:
+            self.state, total_loss_val, logits = train_epochs(self.state, data.X, data.y, data.mask, num_epochs=num_epochs)
+        return total_loss_val, logits[:data.n]
 
-    def fit(self, X, y, eval_set=None):
-        for i in range(self.num_epochs):
-            total_loss_val, logits = self.one_epoch(X, y, final_epoch=(i == self.num_epochs-1))
+    def one_epoch(self, X, y, final_epoch=False):
+        return self.run_epochs(X, y, num_epochs=1)
+
+    def fit(self, X, y=None, eval_set=None):
+        data = self.to_device(X, y)
+        total_loss_val, logits = self.run_epochs(data, num_epochs=self.num_epochs)
 
         self.metric_store.log({'loss': {'training': total_loss_val}})
-        self.metric_store.calculate_metrics(y, jax.nn.sigmoid(logits), 'training')
+        self.metric_store.calculate_metrics(data.y_host, jax.nn.sigmoid(logits), 'training')
         
 
         # if eval_set is not None:
@@ -190,17 +391,14 @@ class NNWrapper:
 
 
 
-    def update(self, X, y, eval_set):
-        idx = np.random.permutation(X.shape[0])
-
-        X = X[idx, ...]
-        y = y[idx]
-
-        for i in range(self.num_update_epochs):
-            total_loss_val, logits = self.one_epoch(X, y, final_epoch=(i == self.num_update_epochs-1))
+    def update(self, X, y=None, eval_set=None):
+        # shuffled on device, see train_epochs_shuffled. The labelled set grows a little every
+        # update, so it is bucketed to keep the number of compiled shapes small
+        data = self.to_device(X, y, bucket=True)
+        total_loss_val, logits = self.run_epochs(data, num_epochs=self.num_update_epochs, shuffle=True)
         
         self.metric_store.log({'loss': {'training': total_loss_val}})
-        self.metric_store.calculate_metrics(y, jax.nn.sigmoid(logits), 'training')
+        self.metric_store.calculate_metrics(data.y_host, jax.nn.sigmoid(logits), 'training')
 
         if eval_set is not None:
             eval_set_names = ['training', 'validation', 'test']
@@ -213,25 +411,33 @@ class NNWrapper:
             self.metric_store.calculate_metrics(y_val, jax.nn.sigmoid(logits), eval_set_names[i])
 
 
-    def predict(self, X_test):
-        return self.model.apply(self.params, X_test)
+    def predict(self, X_test, chunk_size=None, dtype=None):
+        '''
+        Predicted probability of fraud for each row of X_test, using the current (trained) parameters.
+        Scores chunk_size rows per jitted call (default predict_chunk_size), in precision dtype
+        (default predict_dtype). Returns a float32 numpy array.
+        '''
+        chunk_size = chunk_size or self.predict_chunk_size
+        dtype = dtypes_str2dtype[dtype or self.predict_dtype]
+
+        probs = []
+        for i in range(0, X_test.shape[0], chunk_size):
+            X_chunk = jnp.asarray(X_test[i:i+chunk_size])
+            n = X_chunk.shape[0]
+            # pad to a bucket size so the last chunk and smaller pools reuse the same compiled shapes
+            padded = min(bucket_size(n, minimum=self.batch_size), max(chunk_size, n))
+            X_chunk = jnp.pad(X_chunk, ((0, padded - n), (0, 0)))
+            probs.append(predict_step(self.model, self.state.params, X_chunk, dtype=dtype)[:n])
+
+        if not probs:
+            return np.zeros(0, dtype=np.float32)
+        return np.asarray(jnp.concatenate(probs))
     
     def validation(self, eval_set):
-        X_val, y_val = eval_set
-        
-        logits_collection = []
-        total_loss_val = 0
-        for i in range(0, X_val.shape[0], self.batch_size):
-            X_batch = X_val[i:i+self.batch_size]
-            y_batch = y_val[i:i+self.batch_size]
-
-            loss_val, logits = eval_step(self.state, X_batch, y_batch)
-
-            logits_collection.append(logits)
-            total_loss_val += loss_val*X_batch.shape[0]
+        data = eval_set if isinstance(eval_set, DeviceDataset) else self.to_device(*eval_set)
 
-        logits = jnp.concatenate(logits_collection, axis=0)
-        total_loss_val /= X_val.shape[0]
+        total_loss_val, logits = eval_epoch(self.state, data.X, data.y, data.mask)
+        logits = logits[:data.n]
 
         # self.update_metrics(total_loss_val, logits, y_val, 'validation', final_epoch=True)
 
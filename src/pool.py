@@ -0,0 +1,66 @@
+import numpy as np
+
+class LabelPool():
+    '''
+    Labelled/unlabelled split of one immutable feature matrix.
+
+    Membership is kept as a boolean mask plus the list of labelled rows (in the order
+    they were labelled), so moving K rows from unlabelled to labelled only touches K
+    entries rather than copying the pool with np.delete/np.concatenate.
+
+    Positions into the unlabelled data (e.g. the indices returned by sampler) refer to
+    the unlabelled rows in ascending row order, i.e. the same order np.delete would
+    leave them in.
+    '''
+    def __init__(self, X:np.ndarray, y:np.ndarray, labelled_idx:np.ndarray):
+        self.X = X
+        self.y = y
+        self.labelled_mask = np.zeros(len(X), dtype=bool)
+        self.labelled_mask[labelled_idx] = True
+        self.labelled_idx = np.asarray(labelled_idx, dtype=np.int64)
+        self._unlabelled_idx = None
+
+    @classmethod
+    def from_split(cls, X:np.ndarray, y:np.ndarray, X_unlabelled:np.ndarray, y_unlabelled:np.ndarray):
+        '''Builds the pool from separate labelled and unlabelled arrays (copies them once).'''
+        return cls(np.concatenate([X, X_unlabelled]), np.concatenate([y, y_unlabelled]), np.arange(len(X)))
+
+    def unlabelled_idx(self):
+        '''Rows of X that are still unlabelled, in ascending order.'''
+        if self._unlabelled_idx is None:
+            self._unlabelled_idx = np.flatnonzero(~self.labelled_mask)
+        return self._unlabelled_idx
+
+    def label(self, positions):
+        '''
+        Moves the unlabelled rows at the given positions into the labelled set.
+        Returns their row indices into X.
+        '''
+        rows = self.unlabelled_idx()[np.unique(np.asarray(positions))]
+        self.labelled_mask[rows] = True
+        self.labelled_idx = np.concatenate([self.labelled_idx, rows])
+        self._unlabelled_idx = None
+        return rows
+
+    def labelled(self):
+        '''Features and labels of the labelled rows.'''
+        return self.X[self.labelled_idx], self.y[self.labelled_idx]
+
+    def unlabelled(self):
+        '''Features and (true) labels of the unlabelled rows.'''
+        idx = self.unlabelled_idx()
+        return self.X[idx], self.y[idx]
+
+    def iter_unlabelled(self, chunk_size:int):
+        '''Yields the unlabelled features chunk by chunk, only ever gathering one chunk at a time.'''
+        idx = self.unlabelled_idx()
+        for i in range(0, len(idx), chunk_size):
+            yield self.X[idx[i:i+chunk_size]]
+
+    @property
+    def n_labelled(self):
+        return len(self.labelled_idx)
+
+    @property
+    def n_unlabelled(self):
+        return len(self.X) - len(self.labelled_idx)
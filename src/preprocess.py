@@ -1,67 +1,261 @@
+import os
+import json
 import pandas as pd
 import numpy as np
 from typing import Optional, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.preprocessing import normalize
+from utils import SPLITS, write_cache, read_cache, open_cache, finish_cache, read_rows, write_variant_masks
 
 
-def train_test_split(
-    df, train_size=0.6, validate_size=0.2, test_size=0.2, seed=20142015
+LOG_SCALED_COLUMNS = [
+    "days_since_request",
+    "zip_count_4w",
+    "proposed_credit_limit",
+]
+
+
+class CategoryEncoder:
+    """
+    One-hot encoder with a persisted category vocabulary.
+
+    pd.get_dummies only creates columns for the categories present in the frame it is
+    given, so a chunk (or a single row) can come out with fewer or differently ordered
+    columns. This encoder fixes the vocabulary once (fit, or partial_fit over chunks) and
+    always emits the same columns, in the same order and with the same names as
+    pd.get_dummies on the full data: the numeric columns, then "<column>_<category>" for
+    the sorted categories of each categorical column. Unseen categories and missing values
+    encode as all zeros.
+    """
+
+    def __init__(self, numeric_columns=None, vocab=None):
+        self.numeric_columns = None if numeric_columns is None else list(numeric_columns)
+        self.vocab = None if vocab is None else {col: list(cats) for col, cats in vocab.items()}
+        self._category_index = None
+
+    def partial_fit(self, df):
+        """Adds the categories in df to the vocabulary (the first call also fixes the columns)."""
+        if self.numeric_columns is None:
+            categorical_columns = list(df.select_dtypes(include=["object", "category", "string"]).columns)
+            self.numeric_columns = [c for c in df.columns if c not in categorical_columns]
+            self.vocab = {col: [] for col in categorical_columns}
+
+        for col, categories in self.vocab.items():
+            self.vocab[col] = sorted(set(categories).union(df[col].dropna().unique()))
+        self._category_index = None
+        return self
+
+    def fit(self, df):
+        self.numeric_columns, self.vocab = None, None
+        return self.partial_fit(df)
+
+    @property
+    def dummy_columns(self):
+        return [f"{col}_{cat}" for col, cats in self.vocab.items() for cat in cats]
+
+    @property
+    def columns(self):
+        return self.numeric_columns + self.dummy_columns
+
+    @property
+    def n_features(self):
+        return len(self.numeric_columns) + sum(len(cats) for cats in self.vocab.values())
+
+    def transform_dummies(self, df, dtype=np.uint8):
+        """Encodes only the categorical columns of df, as a (len(df), len(dummy_columns)) matrix."""
+        dummies = np.zeros((len(df), len(self.dummy_columns)), dtype=dtype)
+        rows = np.arange(len(df))
+        offset = 0
+        for col, categories in self.vocab.items():
+            codes = pd.Categorical(df[col], categories=categories).codes
+            seen = codes >= 0
+            dummies[rows[seen], offset + codes[seen]] = 1
+            offset += len(categories)
+        return dummies
+
+    def transform(self, df, dtype=np.float32):
+        """Encodes df into one contiguous (len(df), n_features) matrix, laid out as self.columns."""
+        X = np.empty((len(df), self.n_features), dtype=dtype)
+        n_numeric = len(self.numeric_columns)
+        X[:, :n_numeric] = df[self.numeric_columns].to_numpy(dtype=dtype)
+        X[:, n_numeric:] = self.transform_dummies(df, dtype=dtype)
+        return X
+
+    def transform_frame(self, df):
+        """Drop-in for pd.get_dummies(df): the numeric columns untouched, followed by uint8 dummies."""
+        dummies = pd.DataFrame(self.transform_dummies(df), columns=self.dummy_columns, index=df.index)
+        return pd.concat([df[self.numeric_columns], dummies], axis=1)
+
+    def transform_row(self, row, dtype=np.float32):
+        """Encodes a single record (a dict or anything indexable by column name) without going through pandas."""
+        if self._category_index is None:
+            self._category_index = {
+                col: {cat: i for i, cat in enumerate(cats)} for col, cats in self.vocab.items()
+            }
+
+        x = np.zeros(self.n_features, dtype=dtype)
+        for j, col in enumerate(self.numeric_columns):
+            x[j] = row[col]
+        offset = len(self.numeric_columns)
+        for col, categories in self.vocab.items():
+            i = self._category_index[col].get(row[col])
+            if i is not None:
+                x[offset + i] = 1
+            offset += len(categories)
+        return x
+
+    def fit_transform(self, df, dtype=np.float32):
+        return self.fit(df).transform(df, dtype=dtype)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"numeric_columns": self.numeric_columns, "vocab": self.vocab}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            state = json.load(f)
+        return cls(state["numeric_columns"], state["vocab"])
+
+
+def _log_scale(X, columns):
+    """Applies the same log scaling as preprocess_data to the matching columns of an encoded matrix, in place."""
+    for col in LOG_SCALED_COLUMNS:
+        if col in columns:
+            j = columns.index(col)
+            X[:, j] = np.log1p(X[:, j])
+    return X
+
+
+def split_indices(
+    fraud_bool, train_size=0.6, validate_size=0.2, seed=20142015, stratify=False
 ):
     """
-    Split the data into training, validation, and test sets and save them to csv files.
+    Assign rows to the training, validation and test sets by a seeded permutation of their positions.
+
+    Without stratify this is the same split as shuffling with df.sample(frac=1) under np.random.seed(seed).
+    With stratify each class is split separately, so every set keeps the overall fraud rate.
+    Returns the (train, validate, test) row positions.
     """
-    np.random.seed(seed)
+    rng = np.random.RandomState(seed)
+    fraud_bool = np.asarray(fraud_bool)
 
-    # # Split the data into training validation and test sets with 60%, 20%, 20% respectively
-    # train, validate, test = np.split(df.sample(frac=1), [int(.6*len(df)), int(.8*len(df))])
+    def split(idx):
+        idx = idx[rng.permutation(len(idx))]
+        return np.split(
+            idx, [int(train_size * len(idx)), int((train_size + validate_size) * len(idx))]
+        )
+
+    if not stratify:
+        return split(np.arange(len(fraud_bool)))
+
+    per_class = [split(np.flatnonzero(fraud_bool == c)) for c in np.unique(fraud_bool)]
+    # shuffle each set so the classes are interleaved
+    return [np.concatenate(parts)[rng.permutation(sum(len(p) for p in parts))] for parts in zip(*per_class)]
 
-    # Split the data into training validation and test sets using the provided sizes
-    train, validate, test = np.split(
-        df.sample(frac=1),
-        [int(train_size * len(df)), int((train_size + validate_size) * len(df))],
+
+def train_test_split(
+    df,
+    train_size=0.6,
+    validate_size=0.2,
+    test_size=0.2,
+    seed=20142015,
+    out_dir="../data/harry",
+    stratify=False,
+    write_csv=False,
+):
+    """
+    Split the data into training, validation, and test sets and save them as the binary
+    cache loaded by utils.get_data (and optionally as csv files).
+
+    Rows are assigned to sets by index (see split_indices) and each set is written
+    concurrently, straight from df, so no shuffled copy of the data is made.
+    """
+    splits = split_indices(
+        df["fraud_bool"],
+        train_size=train_size,
+        validate_size=validate_size,
+        seed=seed,
+        stratify=stratify,
     )
 
-    # Save the data to csv files
-    train.to_csv("../data/harry/train.csv", index=False)
-    validate.to_csv("../data/harry/validate.csv", index=False)
-    test.to_csv("../data/harry/test.csv", index=False)
+    def write(split, rows):
+        # csv first, the cache records which csv it matches (see utils.has_cache)
+        if write_csv:
+            df.iloc[rows].to_csv(os.path.join(out_dir, f"{split}.csv"), index=False)
+        write_cache(df, out_dir, split, rows=rows)
+
+    os.makedirs(out_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(write, split, rows)
+            for split, rows in zip(["train", "validate", "test"], splits)
+        ]
+        for future in futures:
+            future.result()
+
 
+def correlated_features(df, threshold=0.7, sample_size=None, seed=20142015):
+    """
+    Find the columns to drop because they correlate above threshold with an earlier column.
 
-def preprocess_data(df, log_scaling=True, drop_highly_correlated_features=True):
+    Computes a single float32 correlation matrix (on a random subsample of sample_size rows
+    if given) and picks the columns from its lower triangle with array operations.
+    """
+    if sample_size is not None and sample_size < len(df):
+        df = df.sample(n=sample_size, random_state=seed)
+
+    X = df.to_numpy(dtype=np.float32)
+    X -= X.mean(axis=0, dtype=np.float64).astype(np.float32)
+    norms = np.sqrt(np.einsum("ij,ij->j", X, X))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = (X.T @ X) / np.outer(norms, norms)
+
+    # column i is dropped if it correlates above threshold with any column j < i
+    # (NaN correlations, e.g. from constant columns, never exceed the threshold)
+    above = np.tril(corr, k=-1) > threshold
+    return list(df.columns[above.any(axis=1)])
+
+
+def preprocess_data(
+    df,
+    log_scaling=True,
+    drop_highly_correlated_features=True,
+    correlation_threshold=0.7,
+    correlation_sample_size=None,
+    dropped_features=None,
+    encoder=None,
+):
     """
     Preprocess the data by removing any missing values and encoding the categorical variables.
+
+    encoder: a fitted CategoryEncoder to encode with instead of fitting one on df, so the
+             columns match an earlier run. The encoder used is recorded in df.attrs["encoder"].
+
+    dropped_features: columns to drop instead of recomputing the correlations (e.g. to replay
+                      the pruning of an earlier run on new data). The columns that were dropped
+                      are recorded in df.attrs["dropped_features"].
     """
-    df = pd.get_dummies(df)
+    if encoder is None:
+        encoder = CategoryEncoder().fit(df)
+    df = encoder.transform_frame(df)
 
     if log_scaling:
-        columns_to_transform = [
-            "days_since_request",
-            "zip_count_4w",
-            "proposed_credit_limit",
-        ]
-
         # Apply natural logarithm transformation to specified columns
-        df[columns_to_transform] = np.log1p(df[columns_to_transform])
+        df[LOG_SCALED_COLUMNS] = np.log1p(df[LOG_SCALED_COLUMNS])
 
     if drop_highly_correlated_features:
-        cor = df.corr()
-        mask = np.triu(np.ones_like(cor))
-
-        def correlation(dataset, threshold):
-            col_corr = set()
-            corr_matrix = dataset.corr()
-            for i in range(len(corr_matrix.columns)):
-                for j in range(i):
-                    if (corr_matrix.iloc[i, j]) > threshold:
-                        colname = corr_matrix.columns[i]
-                        col_corr.add(colname)
-            return col_corr
-
-        corr_features = correlation(df, 0.7)
-
-        df = df.drop(corr_features, axis=1)
+        if dropped_features is None:
+            dropped_features = correlated_features(
+                df, correlation_threshold, sample_size=correlation_sample_size
+            )
+
+        df = df.drop(dropped_features, axis=1)
+        df.attrs["dropped_features"] = list(dropped_features)
         # df = df.drop('payment_type_AA', axis=1)
 
+    df.attrs["encoder"] = encoder
     return df
 
 
@@ -86,44 +280,37 @@ def _get_sample_numbers(N, alpha, beta, gamma):
     return a, b, c, d
 
 
-def _splitdfs_by_weights(
-    tp_subdf: pd.DataFrame,
-    tn_subdf: pd.DataFrame,
-    tp_weights: Iterable[float],
-    tn_weights: Iterable[float],
+def _choose_by_weights(
+    tp_idx: np.ndarray,
+    tn_idx: np.ndarray,
+    tp_weights: Optional[np.ndarray],
+    tn_weights: Optional[np.ndarray],
     a: int,
     b: int,
-    seed = 20142015
+    seed=20142015,
 ):
-    np.random.seed(seed)
+    rng = np.random.RandomState(seed)
     # select a labels from true positives
-    a_idxs = np.random.choice(tp_subdf.index, a, replace=False, p=tp_weights)
-    # split true positives into a and c
-    a_subdf: pd.DataFrame = tp_subdf.loc[a_idxs]
-    c_subdf: pd.DataFrame = tp_subdf.drop(index=a_idxs)
-
+    a_idxs = rng.choice(tp_idx, a, replace=False, p=tp_weights)
     # select b labels from true negatives
-    b_idxs = np.random.choice(tn_subdf.index, b, replace=False, p=tn_weights)
-    # split true negatives into b and d
-    b_subdf: pd.DataFrame = tn_subdf.loc[b_idxs]
-    d_subdf: pd.DataFrame = tn_subdf.drop(index=b_idxs)
+    b_idxs = rng.choice(tn_idx, b, replace=False, p=tn_weights)
 
-    return a_subdf, b_subdf, c_subdf, d_subdf
+    return a_idxs, b_idxs
 
 
 def _get_weights(
-    probs: Optional[Iterable[float]],
-    tp_mask: pd.Series,
-    tn_mask: pd.Series,
+    probs: Optional[np.ndarray],
+    tp_idx: np.ndarray,
+    tn_idx: np.ndarray,
 ):
     # split weights into true positives and true negatives
     if probs is not None:
-        tp_weights = probs[tp_mask]
-        tn_weights = probs[tn_mask]
+        tp_weights = probs[tp_idx]
+        tn_weights = probs[tn_idx]
             
         # normalize the weights
-        tp_weights = np.array(tp_weights).reshape(-1, 1)
-        tn_weights = np.array(tn_weights).reshape(-1, 1)
+        tp_weights = tp_weights.reshape(-1, 1)
+        tn_weights = tn_weights.reshape(-1, 1)
         tp_weights = normalize(tp_weights, axis=0, norm="l1").flatten()
         tn_weights = normalize(tn_weights, axis=0, norm="l1").flatten()
     else:
@@ -133,6 +320,57 @@ def _get_weights(
     return tp_weights, tn_weights
 
 
+def delabel_mask(
+    fraud_bool: np.ndarray,
+    labelled_proportion: float,
+    labelled_positive_proportion: float,
+    probs: Optional[Iterable[float]] = None,
+    top_probs_only: bool = False,
+    seed=20142015,
+):
+    """
+    Boolean mask of the samples whose label is kept, see remove_labels for the arguments.
+    Works on the label (and weight) arrays only, so it is cheap to rerun for many settings.
+    """
+    # check that the proportions are valid
+    assert labelled_proportion >= 0 and labelled_proportion <= 1
+    assert labelled_positive_proportion >= 0 and labelled_positive_proportion <= 1
+    # check that the weights are valid
+    if probs is not None:
+        probs = np.asarray(probs, dtype=float)
+        assert np.all(probs >= 0)
+        assert len(probs) == len(fraud_bool)
+
+    fraud_bool = np.asarray(fraud_bool)
+    tp_idx = np.flatnonzero(fraud_bool == 1)
+    tn_idx = np.flatnonzero(fraud_bool == 0)
+
+    N = len(fraud_bool)
+    alpha = len(tp_idx) / N
+    beta = labelled_proportion
+    gamma = labelled_positive_proportion
+
+    a, b, c, d = _get_sample_numbers(N, alpha, beta, gamma)
+
+    if probs is not None and top_probs_only:
+        # keep the highest weights in each class, ties going to the earlier sample
+        a_idxs = tp_idx[np.argsort(-probs[tp_idx], kind="stable")[:a]]
+        b_idxs = tn_idx[np.argsort(-probs[tn_idx], kind="stable")[:b]]
+    else:
+        # get weights for each sample
+        tp_weights, tn_weights = _get_weights(probs, tp_idx, tn_idx)
+
+        # pick the labelled true positives and labelled true negatives
+        a_idxs, b_idxs = _choose_by_weights(
+            tp_idx, tn_idx, tp_weights, tn_weights, a, b, seed=seed
+        )
+
+    keep = np.zeros(N, dtype=bool)
+    keep[a_idxs] = True
+    keep[b_idxs] = True
+    return keep
+
+
 def remove_labels(
     df: pd.DataFrame,
     labelled_proportion: float,
@@ -143,6 +381,7 @@ def remove_labels(
 ):
     """
     Remove some labels from the dataset (replace with np.nan).
+    The fraud_masked column is written to df in place.
 
     true_pos_proportion: num true samples/num all samples
     human_labelled_proportion: num human labelled samples/num all samples
@@ -157,100 +396,306 @@ def remove_labels(
                     i.e. a positive with weight 0.8 is twice as likely stay labelled as a positive with weight 0.4
                     labelled_proportion and labelled_postive_proportion still enforced
     """
+    fraud_bool = df["fraud_bool"].to_numpy()
+    keep = delabel_mask(
+        fraud_bool,
+        labelled_proportion,
+        labelled_positive_proportion,
+        probs=probs,
+        top_probs_only=top_probs_only,
+        seed=seed,
+    )
 
-    np.random.seed(seed)
+    # add a column to the dataframe that is the fraud_bool column but with the labels removed
+    df["fraud_masked"] = np.where(keep, fraud_bool.astype(float), np.nan)
 
-    # check that the proportions are valid
-    assert labelled_proportion >= 0 and labelled_proportion <= 1
-    assert labelled_positive_proportion >= 0 and labelled_positive_proportion <= 1
-    # check that the weights are valid
-    if probs is not None:
-        assert all([w >= 0 for w in probs])
-        assert len(probs) == len(df)
-        df["probs"] = probs
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
 
-    # add a column to the dataframe that is the fraud_bool column but with the labels removed
-    df["fraud_masked"] = df["fraud_bool"]
+    return df
 
-    tp_mask: pd.Series = df["fraud_bool"] == 1
-    tn_mask: pd.Series = df["fraud_bool"] == 0
+def variant_key(
+    labelled_proportion: float,
+    labelled_positive_proportion: float,
+    probs: Optional[str] = None,
+    top_probs_only: bool = False,
+    seed=20142015,
+):
+    """
+    Name under which a delabelling setting is stored by write_label_variants,
+    e.g. "lp=0.01_lpp=0.4_probs=weaklearner_top=1_seed=20142015".
+    """
+    return (
+        f"lp={labelled_proportion}_lpp={labelled_positive_proportion}"
+        f"_probs={probs}_top={int(top_probs_only)}_seed={seed}"
+    )
 
-    N = len(df)
-    alpha = sum(tp_mask) / N
-    beta = labelled_proportion
-    gamma = labelled_positive_proportion
 
-    a, b, c, d = _get_sample_numbers(N, alpha, beta, gamma)
-    
-    # split the dataframe into true positives and true negatives
-    tp_subdf: pd.DataFrame = df[tp_mask]
-    tn_subdf: pd.DataFrame = df[tn_mask]
-    
-    if probs is not None and top_probs_only:
-        tp_weights = probs[tp_mask]
-        tn_weights = probs[tn_mask]
-        a_idxs = tp_subdf.nlargest(a, 'probs').index
-        a_subdf = tp_subdf.loc[a_idxs]
-        b_idxs = tn_subdf.nlargest(b, 'probs').index
-        b_subdf = tn_subdf.loc[b_idxs]
-        c_subdf = tp_subdf.drop(index=a_idxs)
-        d_subdf = tn_subdf.drop(index=b_idxs)
-    else:
-        # get weights for each sample
-        tp_weights, tn_weights = _get_weights(probs, tp_mask, tn_mask)
+def write_label_variants(data_dir, settings, weights=None):
+    """
+    Add delabelled versions of the cached splits in data_dir, without rewriting any features.
 
-        # split dfs into labelled true positives, labelled true negatives, unlabelled true positives, unlabelled true negatives
-        a_subdf, b_subdf, c_subdf, d_subdf = _splitdfs_by_weights(
-            tp_subdf, tn_subdf, tp_weights, tn_weights, a, b
-        )
+    Each setting is delabelled over the full dataset, exactly like remove_labels followed by
+    train_test_split, and only a bit-packed mask of the kept labels is stored per split
+    (see utils.write_variant_masks). Load one with utils.get_data(variant=key).
+    Settings already stored are kept, so new scenarios can be added at any time.
 
-    # remove labels from c_subdf and d_subdf
-    c_subdf["fraud_masked"] = np.nan
-    d_subdf["fraud_masked"] = np.nan
+    settings: list of dicts of remove_labels arguments (labelled_proportion, labelled_positive_proportion,
+              and optionally probs, top_probs_only, seed), where probs is a key of weights
+    weights: dict of named weight vectors, each over the rows of the full dataset
 
-    # concatenate a_subdf, b_subdf, c_subdf, d_subdf
-    df = pd.concat([a_subdf, b_subdf, c_subdf, d_subdf]).sort_index()
+    e.g. write_label_variants("../data/harry", [{"labelled_proportion": 0.01, "labelled_positive_proportion": p} for p in [0.1, 0.4]])
+    Returns the variant keys of the settings.
+    """
+    weights = {} if weights is None else weights
+
+    # labels of the full dataset, put back together from the splits
+    rows = {split: read_rows(data_dir, split) for split in SPLITS}
+    n_rows = sum(len(r) for r in rows.values())
+    # together the splits must cover every row of the full dataset exactly once
+    if not np.array_equal(np.sort(np.concatenate(list(rows.values()))), np.arange(n_rows)):
+        raise ValueError(f"The rows recorded for the splits in {data_dir} are not a partition of the full dataset, "
+                         "rerun preprocess.py to rewrite the cache.")
+    fraud_bool = np.zeros(n_rows, dtype=np.int8)
+    for split in SPLITS:
+        fraud_bool[rows[split]] = read_cache(data_dir, split)[1]
+
+    masks = {split: {} for split in SPLITS}
+    keys = []
+    for setting in settings:
+        probs = setting.get("probs")
+        keep = delabel_mask(
+            fraud_bool,
+            setting["labelled_proportion"],
+            setting["labelled_positive_proportion"],
+            probs=None if probs is None else weights[probs],
+            top_probs_only=setting.get("top_probs_only", False),
+            seed=setting.get("seed", 20142015),
+        )
+        key = variant_key(**setting)
+        keys.append(key)
+        for split in SPLITS:
+            masks[split][key] = keep[rows[split]]
+
+    for split in SPLITS:
+        write_variant_masks(data_dir, split, masks[split])
+    return keys
+
+
+def _read_chunks(files, chunksize):
+    """Yields the rows of all files, chunk by chunk, in file order."""
+    for file in files:
+        for chunk in pd.read_csv(file, chunksize=chunksize):
+            yield chunk
+
+
+def preprocess_chunked(
+    files,
+    out_dir,
+    labelled_proportion,
+    labelled_positive_proportion,
+    probs=None,
+    top_probs_only=False,
+    log_scaling=True,
+    drop_highly_correlated_features=True,
+    correlation_threshold=0.7,
+    train_size=0.6,
+    validate_size=0.2,
+    stratify=False,
+    seed=20142015,
+    chunksize=2**17,
+):
+    """
+    Out-of-core version of preprocess_data -> remove_labels -> train_test_split for csvs
+    too large to load at once (e.g. Base.csv together with all the Variant files).
 
-    assert len(df) == N
-    assert df.index.is_unique
+    The first pass collects the category vocabularies, the labels and the moments
+    (sums and cross products) of the encoded columns, from which the correlations used for
+    pruning are computed exactly. The labels are enough to delabel and assign rows to splits.
+    The second pass encodes, scales and prunes each chunk and writes its rows straight into
+    the memory-mapped splits (utils cache format) in out_dir.
 
-    if probs is not None:
-        df = df.drop(columns=["probs"])
+    probs, if given, must cover the rows of all files in order.
+    """
+    # ----- first pass: vocabularies, labels and moments -----
+    encoder = CategoryEncoder()
+    labels = []
+    names, index = [], {}
+    n = 0
+    sums = np.zeros(0)
+    cross = np.zeros((0, 0))
+
+    for chunk in _read_chunks(files, chunksize):
+        labels.append(chunk["fraud_bool"].to_numpy(dtype=np.int8))
+        encoder.partial_fit(chunk)
+
+        chunk_names = encoder.columns
+        X = encoder.transform(chunk, dtype=np.float64)
+        if log_scaling:
+            _log_scale(X, chunk_names)
+
+        # columns for categories seen for the first time were all zeros in the earlier chunks
+        new_names = [name for name in chunk_names if name not in index]
+        for name in new_names:
+            index[name] = len(names)
+            names.append(name)
+        sums = np.pad(sums, (0, len(new_names)))
+        cross = np.pad(cross, ((0, len(new_names)), (0, len(new_names))))
+
+        idx = np.array([index[name] for name in chunk_names])
+        sums[idx] += X.sum(axis=0)
+        cross[np.ix_(idx, idx)] += X.T @ X
+        n += len(X)
+
+    fraud_bool = np.concatenate(labels)
+
+    columns = encoder.columns
+
+    dropped_features = []
+    if drop_highly_correlated_features:
+        order = np.array([index[name] for name in columns])
+        mean = sums[order] / n
+        cov = (cross[np.ix_(order, order)] - n * np.outer(mean, mean)) / (n - 1)
+        std = np.sqrt(np.diag(cov))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr = cov / np.outer(std, std)
+        above = np.tril(corr, k=-1) > correlation_threshold
+        dropped_features = [col for col, drop in zip(columns, above.any(axis=1)) if drop]
+
+    kept = [j for j, col in enumerate(columns) if col not in dropped_features]
+    features = [columns[j] for j in kept if columns[j] != "fraud_bool"]
+    feature_idx = np.array([j for j in kept if columns[j] != "fraud_bool"])
+
+    # ----- delabel and assign rows to splits, from the labels alone -----
+    keep = delabel_mask(
+        fraud_bool,
+        labelled_proportion,
+        labelled_positive_proportion,
+        probs=probs,
+        top_probs_only=top_probs_only,
+        seed=seed,
+    )
+    fraud_masked = np.where(keep, fraud_bool, np.nan).astype(np.float32)
 
-    return df
+    split_names = ["train", "validate", "test"]
+    splits = split_indices(
+        fraud_bool, train_size=train_size, validate_size=validate_size, seed=seed, stratify=stratify
+    )
+    # which split each row goes to, and its position in that split
+    split_of = np.zeros(n, dtype=np.int8)
+    position = np.zeros(n, dtype=np.int64)
+    outputs = []
+    for s, (name, rows) in enumerate(zip(split_names, splits)):
+        split_of[rows] = s
+        position[rows] = np.arange(len(rows))
+        arrays = open_cache(out_dir, name, len(rows), features)
+        arrays["fraud_bool"][:] = fraud_bool[rows]
+        arrays["fraud_masked"][:] = fraud_masked[rows]
+        outputs.append(arrays)
+
+    # ----- second pass: encode, scale, prune and write each chunk -----
+    start = 0
+    for chunk in _read_chunks(files, chunksize):
+        X = encoder.transform(chunk, dtype=np.float64)
+        if log_scaling:
+            _log_scale(X, columns)
+        X = X[:, feature_idx]
+        chunk_split = split_of[start : start + len(X)]
+        chunk_position = position[start : start + len(X)]
+        for s, arrays in enumerate(outputs):
+            in_split = chunk_split == s
+            arrays["features"][chunk_position[in_split]] = X[in_split]
+        start += len(X)
+
+    for name, arrays, rows in zip(split_names, outputs, splits):
+        finish_cache(out_dir, name, arrays, features, rows=rows)
+
+    with open(os.path.join(out_dir, "dropped_features.json"), "w") as f:
+        json.dump(dropped_features, f)
+    encoder.save(os.path.join(out_dir, "encoder.json"))
+
+    return dropped_features
+
+
+VARIANT_FILES = ["Variant I.csv", "Variant II.csv", "Variant III.csv", "Variant IV.csv", "Variant V.csv"]
 
 if __name__ == "__main__":
-    # Load the data
-    print("Loading data...")
-    df = pd.read_csv("../data/archive/Base.csv")
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunked", action="store_true", help="Stream the csvs in chunks instead of loading them into memory")
+    parser.add_argument("--all_variants", action="store_true", help="Also include the five Variant files alongside Base.csv")
+    parser.add_argument("--chunksize", type=int, default=2**17, help="Rows per chunk when --chunked")
+    parser.add_argument("--labelled_proportions", type=str, default="0.01", help="Comma separated labelled proportions to store as label variants")
+    parser.add_argument("--labelled_positive_proportions", type=str, default="0.4", help="Comma separated labelled positive proportions to store as label variants")
+    parser.add_argument("--variants_only", action="store_true", help="Only add label variants to the existing cache, without preprocessing again")
+    args = parser.parse_args()
 
-    # Preprocess the data
-    print("Preprocessing features...")
-    df = preprocess_data(df, log_scaling=True, drop_highly_correlated_features=True)
+    files = ["../data/archive/Base.csv"]
+    if args.all_variants:
+        files += [os.path.join("../data/archive", f) for f in VARIANT_FILES]
 
     # Remove some labels
     labelled_proportion = 0.01
     labelled_positive_proportion = 0.4
 
-    # If using the weak learner results for de-labelling:
-    # import them here, 
-    # then change the probs argument to newprobs
-    # (and set top_probs_only as desired)
-    weak_learner_results = pd.read_csv("./preprocess/weaklearner_weights.csv")
-    newprobs = weak_learner_results["y_prob"]
-
-    print("Removing labels...")
-    df = remove_labels(
-        df,
-        labelled_proportion=labelled_proportion,
-        labelled_positive_proportion=labelled_positive_proportion,
-        probs=None,
-        # probs=newprobs,
-        top_probs_only=True,
-    )
+    os.makedirs("../data/harry", exist_ok=True)
+
+    if args.variants_only:
+        pass
+    elif args.chunked:
+        print("Preprocessing, removing labels and splitting in chunks...")
+        preprocess_chunked(
+            files,
+            "../data/harry",
+            labelled_proportion=labelled_proportion,
+            labelled_positive_proportion=labelled_positive_proportion,
+            top_probs_only=True,
+            chunksize=args.chunksize,
+        )
+    else:
+        # Load the data
+        print("Loading data...")
+        df = pd.concat([pd.read_csv(f) for f in files], ignore_index=True)
+
+        # Preprocess the data
+        print("Preprocessing features...")
+        df = preprocess_data(df, log_scaling=True, drop_highly_correlated_features=True)
+
+        # Keep the pruned columns and the category vocabulary so the same encoding can be replayed on new data
+        with open("../data/harry/dropped_features.json", "w") as f:
+            json.dump(df.attrs["dropped_features"], f)
+        df.attrs["encoder"].save("../data/harry/encoder.json")
+
+        # If using the weak learner results for de-labelling:
+        # import them here, 
+        # then change the probs argument to newprobs
+        # (and set top_probs_only as desired)
+        weak_learner_results = pd.read_csv("./preprocess/weaklearner_weights.csv")
+        newprobs = weak_learner_results["y_prob"]
+
+        print("Removing labels...")
+        df = remove_labels(
+            df,
+            labelled_proportion=labelled_proportion,
+            labelled_positive_proportion=labelled_positive_proportion,
+            probs=None,
+            # probs=newprobs,
+            top_probs_only=True,
+        )
 
-    # Split the data
-    print("Splitting data...")
-    train_test_split(df)
+        # Split the data
+        print("Splitting data...")
+        train_test_split(df)
+
+    # Other delabelling scenarios only add a mask per split, pass a key to exp.py --label_variant to use one
+    print("Writing label variants...")
+    settings = [
+        {"labelled_proportion": float(lp), "labelled_positive_proportion": float(lpp), "top_probs_only": True}
+        for lp in args.labelled_proportions.split(",")
+        for lpp in args.labelled_positive_proportions.split(",")
+    ]
+    for key in write_label_variants("../data/harry", settings):
+        print(key)
 
     print("Data preprocessing done.")
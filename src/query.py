@@ -1,178 +1,333 @@
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import jax as jax
 import jax.numpy as jnp
+import numpy as np
 from skactiveml.pool import UncertaintySampling
 from sklearn.preprocessing import StandardScaler
+from sklearn.cluster import MiniBatchKMeans
 
 '''
-For these sampling and similarity functions, we will assume that we are given a 
-prepredicted dataset (predicted_data), which consists of:
-
-predicted_data[0:-2] = covariates
-predicted_data[-1] = predicted prob of labels via the model
+For these sampling and similarity functions, we will assume that we are given the
+model's predictions on the unlabelled data (probs), a 1D array of the predicted prob
+of fraud for each sample. Strategies that need the covariates (the representativeness
+based ones) are handed the unlabelled feature matrix (X) separately, so the
+uncertainty-only strategies never touch it.
 
 '''
 
 # Defining Similarity functions 
 ###################################
-def representativeness_rbf(unlabelled_data, sigma, beta):
+similarity_str2fn = {
+    'rbf': lambda dist, sigma: jnp.exp(dist / sigma),
+    'euclidean': lambda dist, sigma: dist,
+}
+
+def _pairwise_similarity(X, Y, sigma, similarity='rbf', X_sq=None, Y_sq=None):
+    '''Similarity matrix between the rows of X and the rows of Y.'''
+    X_sq = jnp.sum(X**2, axis=-1) if X_sq is None else X_sq
+    Y_sq = jnp.sum(Y**2, axis=-1) if Y_sq is None else Y_sq
+    # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+    sq_dist = X_sq[:, None] + Y_sq[None, :] - 2 * X @ Y.T
+    dist = jnp.sqrt(jnp.maximum(sq_dist, 0.0))
+    return similarity_str2fn[similarity](dist, sigma)
+
+def _to_blocks(X, block_size):
+    '''Pads X to a whole number of blocks and returns (blocks, squared norms, validity mask).'''
+    n, d = X.shape
+    n_blocks = -(-n // block_size)
+    X = jnp.pad(X, ((0, n_blocks * block_size - n), (0, 0)))
+    valid = (jnp.arange(n_blocks * block_size) < n).reshape(n_blocks, block_size)
+    blocks = X.reshape(n_blocks, block_size, d)
+    return blocks, jnp.sum(blocks**2, axis=-1), valid
+
+@partial(jax.jit, static_argnames=('similarity', 'block_size'))
+def _blocked_similarity_sum(X, Y, weights, sigma, spread, similarity='rbf', block_size=1024):
+    """
+    Computes sum_j weights[j] * similarity(X[i], Y[j]) for each row of X, where spread[j] is
+    added to the squared distances to Y[j] (see _landmarks).
+
+    The pairwise distances are computed tile by tile (block_size x block_size), so
+    memory stays at O(block_size^2) rather than O(n*m), and each tile is a single
+    matmul that XLA spreads over all cores.
+    """
+    n = X.shape[0]
+    row_blocks, row_sq_norms, _ = _to_blocks(X, block_size)
+    col_blocks, col_sq_norms, col_valid = _to_blocks(Y, block_size)
+    col_weights = jnp.pad(weights, (0, col_valid.size - weights.shape[0])).reshape(col_valid.shape)
+    col_sq_norms = col_sq_norms + jnp.pad(spread, (0, col_valid.size - spread.shape[0])).reshape(col_valid.shape)
+
+    def row_block(rows):
+        rows_X, rows_sq = rows
+
+        def col_block(total, cols):
+            cols_X, cols_sq, cols_valid, cols_weights = cols
+            sim = _pairwise_similarity(rows_X, cols_X, sigma, similarity, X_sq=rows_sq, Y_sq=cols_sq)
+            sim = jnp.where(cols_valid[None, :], sim * cols_weights[None, :], 0.0)
+            return total + jnp.sum(sim, axis=1), None
+
+        total, _ = jax.lax.scan(col_block, jnp.zeros(block_size, X.dtype), (col_blocks, col_sq_norms, col_valid, col_weights))
+        return total
+
+    totals = jax.lax.map(row_block, (row_blocks, row_sq_norms))
+    return totals.reshape(-1)[:n]
+
+def _similarity_sum(X, Y, weights, sigma, similarity, block_size, spread=None):
+    block_size = min(block_size, X.shape[0], Y.shape[0])
+    spread = jnp.zeros(Y.shape[0], X.dtype) if spread is None else jnp.asarray(spread, dtype=X.dtype)
+    return _blocked_similarity_sum(X, Y, jnp.asarray(weights, dtype=X.dtype), sigma, spread, similarity=similarity, block_size=block_size)
+
+def _landmarks(X, approx, n_landmarks, seed):
+    '''
+    Picks landmark points standing in for the full pool when estimating mean similarity.
+    Returns (landmarks, weights, spread), the weights summing to one.
+        'random': uniform subsample of the pool, each landmark weighted 1/n_landmarks
+        'kmeans': k-means centroids, each weighted by the fraction of the pool in its cluster
+    spread is the mean squared distance of a landmark's cluster members to it (zero for 'random').
+    Since E||x - y||^2 = ||x - c||^2 + spread over the members y of the cluster with centroid c,
+    adding it to the squared distance to a centroid removes most of the bias of measuring against
+    the centroid alone (which puts every member at the centre, so distances come out too small).
+    '''
+    n = X.shape[0]
+    n_landmarks = min(n_landmarks, n)
+    if approx == 'random':
+        idx = jax.random.choice(jax.random.PRNGKey(seed), n, (n_landmarks,), replace=False)
+        return X[idx], jnp.full(n_landmarks, 1 / n_landmarks), jnp.zeros(n_landmarks, X.dtype)
+    elif approx == 'kmeans':
+        X_np = np.asarray(X)
+        kmeans = MiniBatchKMeans(n_clusters=n_landmarks, random_state=seed, n_init=1).fit(X_np)
+        counts = np.bincount(kmeans.labels_, minlength=n_landmarks)
+        sq_dist = np.sum((X_np - kmeans.cluster_centers_[kmeans.labels_])**2, axis=1)
+        spread = np.bincount(kmeans.labels_, weights=sq_dist, minlength=n_landmarks) / np.maximum(counts, 1)
+        return (jnp.asarray(kmeans.cluster_centers_, dtype=X.dtype), jnp.asarray(counts / n),
+                jnp.asarray(spread, dtype=X.dtype))
+    else:
+        raise ValueError(f'Landmark method {approx} not supported')
+
+def mean_similarity(X, sigma=1.0, similarity='rbf', approx=None, n_landmarks=1000, seed=0, block_size=1024):
+    '''
+    Computes the mean similarity of each row of X against every row of X.
+
+    approx: None for the exact O(n^2) computation, otherwise one of
+            'random': Monte Carlo estimate against a random subsample of n_landmarks rows,
+                      error shrinks as O(1/sqrt(n_landmarks)) and is unbiased
+            'kmeans': estimate against n_landmarks k-means centroids weighted by cluster size,
+                      with the cluster spread added to the squared distances (see _landmarks).
+                      Still biased (~0.5% mean relative error at n=10k, d=50, and it does not shrink
+                      with more landmarks; ~20% without the spread correction), and fitting k-means
+                      dominates its cost: slower than the exact computation at that size. Not a
+                      fast option, use 'random' or 'nystrom' for speed
+            'nystrom': Nystrom estimate K_XM K_MM^+ mean_j K_Mj using n_landmarks random rows M
+    The similarity sums cost O(n * n_landmarks), plus the k-means fit for 'kmeans'.
+    '''
+    X = jnp.asarray(X, dtype=jnp.float32)
+    n = X.shape[0]
+
+    if approx is None:
+        return _similarity_sum(X, X, jnp.full(n, 1 / n), sigma, similarity, block_size)
+    elif approx == 'nystrom':
+        M, _, _ = _landmarks(X, 'random', n_landmarks, seed)
+        # mean similarity of each landmark against the full pool
+        landmark_means = _similarity_sum(M, X, jnp.full(n, 1 / n), sigma, similarity, block_size)
+        K_MM = _pairwise_similarity(M, M, sigma, similarity)
+        weights = jnp.linalg.pinv(K_MM, hermitian=True) @ landmark_means
+        return _similarity_sum(X, M, weights, sigma, similarity, block_size)
+    else:
+        M, weights, spread = _landmarks(X, approx, n_landmarks, seed)
+        return _similarity_sum(X, M, weights, sigma, similarity, block_size, spread=spread)
+
+def representativeness_rbf(unlabelled_data, sigma, beta, approx=None, n_landmarks=1000, seed=0, block_size=1024):
     """
     Computes the representativeness for each sample in the unlabelled data.
 
     Parameters:
     - unlabelled_data: The dataset (as a 2D array) of unlabelled samples.
     - sigma: The scaling parameter for the rbf.
+    - beta: The exponent applied to the mean similarity.
+    - approx: Landmark approximation to use (None, 'random', 'kmeans' or 'nystrom'), see mean_similarity.
+    - n_landmarks: Number of landmarks used by the approximation.
+    - seed: Seed for choosing landmarks.
+    - block_size: Number of rows per tile of the pairwise distance computation.
 
     Returns:
     - representativeness: A 1D array containing the representativeness score of each sample.
     """
-    
-    n_samples = unlabelled_data.shape[0]
-    # Initialise vector
-    representativeness = jnp.zeros(n_samples)
-    for i in range(n_samples):
-        euclidean_dist = jnp.linalg.norm(unlabelled_data - unlabelled_data[i], axis=1)
-        # Calculate rbf
-        similarities = jnp.exp(euclidean_dist / sigma)
-        # Calculate representativeness of sample i
-        representativeness = representativeness.at[i].set(jnp.mean(similarities)**beta)
-    
-    return representativeness
+    similarities = mean_similarity(unlabelled_data, sigma=sigma, similarity='rbf', approx=approx, n_landmarks=n_landmarks, seed=seed, block_size=block_size)
+    return similarities**beta
 
-def representativeness_re(unlabelled_data, beta):
+def representativeness_re(unlabelled_data, beta, approx=None, n_landmarks=1000, seed=0, block_size=1024):
     '''
-    
+    Computes the representativeness for each sample in the unlabelled data as its
+    mean euclidean distance to the rest of the (standardised) unlabelled data.
+    See representativeness_rbf for the remaining parameters.
     '''
-    
     scaler = StandardScaler()
-    breakpoint()
     unlabelled_data = scaler.fit_transform(unlabelled_data)
-    
-    n_samples = unlabelled_data.shape[0]
-    # Initialise vector
-    representativeness = jnp.zeros(n_samples)
-    
-    for i in range(n_samples):
-        euclidean_dist = jnp.linalg.norm(unlabelled_data - unlabelled_data[i], axis=1)
-        # Calculate euclidean similarity
-        similarities = euclidean_dist
-        # Calculate representativeness of sample i
-        representativeness = representativeness.at[i].set(jnp.mean(similarities)**beta)
-    return representativeness
+
+    similarities = mean_similarity(unlabelled_data, similarity='euclidean', approx=approx, n_landmarks=n_landmarks, seed=seed, block_size=block_size)
+    return similarities**beta
+
+class RepresentativenessState():
+    '''
+    Running representativeness of an unlabelled pool whose rows only ever leave it.
+
+    Keeps the per-row similarity sums against the whole pool, so removing K rows costs
+    O(K*n) (subtracting their contribution) instead of recomputing the O(n^2) scores.
+    Indices passed to remove() are positions in the current pool, as returned by sampler,
+    so the state stays aligned with an np.delete'd X_unlabelled.
+
+    For 'entrepRE' the standardisation is fitted once on the initial pool.
+    '''
+    def __init__(self, unlabelled_data, method='entrepRE', RE_beta=1, RBF_sigma=0.5, RBF_beta=1, block_size=1024):
+        if method == 'entrepRE':
+            unlabelled_data = StandardScaler().fit_transform(unlabelled_data)
+            self.similarity, self.sigma, self.beta = 'euclidean', 1.0, RE_beta
+        elif method == 'entrepRBF':
+            self.similarity, self.sigma, self.beta = 'rbf', RBF_sigma, RBF_beta
+        else:
+            raise ValueError(f'Method {method} does not use representativeness')
+
+        self.block_size = block_size
+        self.X = jnp.asarray(unlabelled_data, dtype=jnp.float32)
+        n = self.X.shape[0]
+        # sums are accumulated in float64 on the host so repeated subtraction does not drift
+        self.sums = np.asarray(_similarity_sum(self.X, self.X, jnp.ones(n), self.sigma, self.similarity, block_size), dtype=np.float64)
+        # original row index of each row still in the pool
+        self.remaining = np.arange(n)
+
+    def remove(self, idx):
+        '''Removes the rows at positions idx of the current pool.'''
+        idx = np.unique(np.asarray(idx))
+        removed = self.remaining[idx]
+        contribution = _similarity_sum(self.X, self.X[removed], jnp.ones(len(removed)), self.sigma, self.similarity, self.block_size)
+        self.sums -= np.asarray(contribution, dtype=np.float64)
+        self.remaining = np.delete(self.remaining, idx)
+
+    def representativeness(self):
+        '''Representativeness of each row currently in the pool.'''
+        return jnp.asarray(self.sums[self.remaining] / len(self.remaining), dtype=jnp.float32)**self.beta
 
 ###################################
 
 ###################################
 # Define Uncertainty samplers (some of which use similarity functions)
 ###################################
-def centropy(K, predicted_data, labelled_data=None):
+def top_k(scores, K):
+    '''
+    Returns the indices of the K largest scores, in descending order of score.
+    Uses a partial selection (lax.top_k) rather than sorting the whole pool;
+    ties are broken towards the lower index, matching a stable argsort.
+    '''
+    K = min(K, scores.shape[0])
+    _, indices = jax.lax.top_k(scores, K)
+    return indices
+
+def _as_probs(probs):
+    '''Accepts a 1D prob vector, or a 2D array whose last column is the prob (e.g. predict_proba output).'''
+    probs = jnp.asarray(probs)
+    return probs[:, -1] if probs.ndim == 2 else probs
+
+def entropy_score(probs):
+    '''Shannon entropy of each prediction.'''
+    p = jnp.clip(probs, 1e-10, 1 - 1e-10)
+    return -p * jnp.log2(p) - (1 - p) * jnp.log2(1 - p)
+
+def margin_score(probs):
+    '''Negated margin of each prediction, so that larger is more uncertain.'''
+    return -jnp.abs(probs - 0.5)
+
+# strategies whose score for a sample depends only on its own prediction, so can be streamed
+score_str2fn = {
+    'entropy': entropy_score,
+    'margin': margin_score,
+}
+
+def centropy(K, probs, labelled_data=None, y_true=None):
     '''
     --- Ground Truth Cross Entropy Sampling ---
     Returns the top K samples w.r.t the cross entropy of the predictions.
     Requires knowledge of true distribution, not practical in real-world scenarios.
     Maybe a good benchmark?
     -------------------------------------------
-    model: prediction model
     K: number of queries to select
-    unlabelled_data: currently unlabelled data
+    probs: predicted prob of fraud for the unlabelled data
     labelled_data: currently labelled data (may not be used)
+    y_true: true labels of the unlabelled data, their fraud rate is the target distribution q
     '''
-    p = predicted_data[:,-1]
-    p = jnp.clip(predictions[2], 1e-10, 1 - 1e-10)
-    q_value = jnp.mean(predictions[1])
+    if y_true is None:
+        raise ValueError("centropy needs the true labels of the unlabelled data (y_true)")
+    p = jnp.clip(probs, 1e-10, 1 - 1e-10)
+    q_value = jnp.mean(jnp.asarray(y_true, dtype=jnp.float32))
     q = jnp.full(len(p),q_value)
     ce = -q * jnp.log2(p) - (1 - q) * jnp.log2(1 - p)
-    indices = jnp.argsort(-ce)
-    return indices[:K]
+    return top_k(ce, K)
 
-def margin(K, predicted_data, labelled_data=None):
+def margin(K, probs, labelled_data=None):
     '''
     --- Margin Sampling ---
     Returns the K samples with the smallest margin of the predictions.
     -----------------------
-    model: prediction model
     K: number of queries to select
-    unlabelled_data: currently unlabelled data
+    probs: predicted prob of fraud for the unlabelled data
     labelled_data: currently labelled data (may not be used)
     '''
-    p = predicted_data[:,-1]
-    # Calculate the margin of the predictions
-    margin = jnp.abs(p - 0.5)
+    # Return the K samples with the smallest margin
+    return top_k(margin_score(probs), K)
 
-    # Sort the margin values in ascending order and get the indices
-    indices = jnp.argsort(margin)
-
-    # Return the top K samples
-    return indices[:K]
-
-def entropy(K, predicted_data, labelled_data=None):
+def entropy(K, probs, labelled_data=None):
     '''
     --- Shannon Entropy Sampling ---
     Returns the top K samples w.r.t Shannon entropy, produces equvilent outpt to margin
     -------------------------------
-    model: prediction model
     K: number of queries to select
-    unlabelled_data: currently unlabelled data
+    probs: predicted prob of fraud for the unlabelled data
     labelled_data: currently labelled data (may not be used)
     '''
     
-    # Calculate the entropy of the predictions
-    p = predicted_data[:,-1]
-    p = jnp.clip(p, 1e-10, 1 - 1e-10)
-    entropy = -p * jnp.log2(p) - (1 - p) * jnp.log2(1 - p)
-
-    # Sort the entropy values in descending order and get the indices
-    indices = jnp.argsort(-entropy)
+    # Return the top K samples w.r.t the entropy of the predictions
+    return top_k(entropy_score(probs), K)
 
-    # Return the top K samples
-    return indices[:K]
-
-def random(K, predicted_data, labelled_data=None):
+def random(K, probs, labelled_data=None):
     '''
-    model: prediction model
     K: number of queries to select
-    unlabelled_data: currently unlabelled data
+    probs: predicted prob of fraud for the unlabelled data
     labelled_data: currently labelled data (may not be used)
     '''
     key = jax.random.PRNGKey(0)  
-    return jax.random.choice(key, len(predicted_data), (K,), replace=False)
+    return jax.random.choice(key, len(probs), (K,), replace=False)
 
-def entrepRE(K,predicted_data,labelled_data = None,repres_data = []):
+def entrepRE(K,probs,labelled_data = None,repres_data = []):
     '''
     Entropy with similarity constraints
     inputs: 
             K: number of queries to select
-            predicted_data: prediction data from model
+            probs: predicted prob of fraud for the unlabelled data
             labelled_data: currently labelled data
+            repres_data: representativeness of each unlabelled sample
     outputs: indices of selected samples
     '''
-    p = predicted_data[:,-1]
-    p = jnp.clip(p, 1e-10, 1 - 1e-10)
-    entropy = -p * jnp.log2(p) - (1 - p) * jnp.log2(1 - p)
-    loss_func = entropy * repres_data
-    indices = jnp.argsort(-loss_func)
-    return indices[:K]
-
-def entrepRBF(K,predicted_data,labelled_data=None,repres_data = []):
+    loss_func = entropy_score(probs) * repres_data
+    return top_k(loss_func, K)
+
+def entrepRBF(K,probs,labelled_data=None,repres_data = []):
     '''
     Entropy with similarity constraints
-    inputs: model: xgboost or nn
+    inputs: 
             K: number of queries to select
-            unlabelled_data: currently unlabelled data
+            probs: predicted prob of fraud for the unlabelled data
             labelled_data: currently labelled data
+            repres_data: representativeness of each unlabelled sample
     outputs: indices of selected samples
     '''
-    p = predicted_data[:,-1]
-    p = jnp.clip(p, 1e-10, 1 - 1e-10)
-    entropy = -p * jnp.log2(p) - (1 - p) * jnp.log2(1 - p)
-    loss_func = entropy * repres_data
-    indices = jnp.argsort(-loss_func)
-    return indices[:K]
+    loss_func = entropy_score(probs) * repres_data
+    return top_k(loss_func, K)
 
 ###################################
 # Define main query function 
 ###################################
 
-def sampler(predicted_data,
+def sampler(probs,
+            X = None,
             K= 30,
             alpha = 0.5,
             threshold_for_fraud = 0.8,
@@ -180,11 +335,19 @@ def sampler(predicted_data,
             RE_beta = 1,
             RBF_sigma = 0.5,
             RBF_beta = 1,
+            repres_approx = None,
+            n_landmarks = 1000,
+            repres_state = None,
+            y_true = None,
             debug = False):
     '''
     --- Sampler Function ---
     ------------------------
     input:
+    probs: predicted prob of fraud for each unlabelled sample, either a 1D array or a 2D array
+           whose last column is the prob (e.g. predict_proba output)
+    X: unlabelled feature matrix (rows aligned with probs), only read by 'entrepRE'/'entrepRBF'
+       when no repres_state is given
     K: Size of sample
     alpha: proportion of sample required to be FRAUD cases
     threshold_for_fraud: probability at which fraud is decided
@@ -195,6 +358,13 @@ def sampler(predicted_data,
             'margin': Margin Sampling
             'entrepRE': Entropy with similarity constraints via euclidean norm
             'entrepRBF': Entropy with similarity constraints via RBF kernel
+    repres_approx: approximation used for the representativeness of 'entrepRE'/'entrepRBF',
+                   None (exact), 'random', 'kmeans' or 'nystrom', see mean_similarity
+                   ('kmeans' is slow and biased, 'random' and 'nystrom' are the fast ones)
+    n_landmarks: number of landmarks used by repres_approx
+    repres_state: optional RepresentativenessState of the pool, reused instead of recomputing
+                  the representativeness for 'entrepRE'/'entrepRBF'
+    y_true: true labels of the unlabelled samples (rows aligned with probs), only read by 'centropy'
     '''
     # generate a certain amount of fraud cases
     if debug:
@@ -203,33 +373,35 @@ def sampler(predicted_data,
         print("Method: ", method)
     n_fraud = int(K*alpha)
     n_non_fraud = K - n_fraud
+    probs = _as_probs(probs)
     # get the indices of fraud cases
-    fraud_indices = jnp.where(predicted_data[:,-1] > threshold_for_fraud)[0]
+    fraud_indices = jnp.where(probs > threshold_for_fraud)[0]
     fraud_indices_sample = fraud_indices[:n_fraud]
-    # get the indices of non-fraud cases for the sample
-    non_fraud_indices = jnp.where(predicted_data[:,-1] <= threshold_for_fraud)
-    non_fraud_data = predicted_data[non_fraud_indices]
 
 
     #Generate similarity data
-    if method == 'entrepRE':
-        repres_data = representativeness_re(predicted_data[:,0:-1], beta=RE_beta)
+    if method in ['entrepRE', 'entrepRBF'] and repres_state is not None:
+        repres_data = repres_state.representativeness()
+    elif method in ['entrepRE', 'entrepRBF'] and X is None:
+        raise ValueError(f'Method {method} needs the unlabelled features X or a repres_state')
+    elif method == 'entrepRE':
+        repres_data = representativeness_re(X, beta=RE_beta, approx=repres_approx, n_landmarks=n_landmarks)
     elif method == 'entrepRBF':
-        repres_data = representativeness_rbf(predicted_data[:,0:-1], sigma=RBF_sigma, RBF_beta=1)
+        repres_data = representativeness_rbf(X, sigma=RBF_sigma, beta=RBF_beta, approx=repres_approx, n_landmarks=n_landmarks)
     
 
     if method == 'entropy':
-        indices = entropy(n_non_fraud,predicted_data)
+        indices = entropy(n_non_fraud,probs)
     elif method == 'centropy':
-        indices = centropy(n_non_fraud,predicted_data)
+        indices = centropy(n_non_fraud,probs,y_true=y_true)
     elif method == 'random':
-        indices = random(n_non_fraud,predicted_data)
+        indices = random(n_non_fraud,probs)
     elif method == 'margin':
-        indices = margin(n_non_fraud,predicted_data)
+        indices = margin(n_non_fraud,probs)
     elif method == 'entrepRE':
-        indices = entrepRE(n_non_fraud,predicted_data,repres_data=repres_data)
+        indices = entrepRE(n_non_fraud,probs,repres_data=repres_data)
     elif method == 'entrepRBF':
-        indices = entrepRBF(n_non_fraud,predicted_data,repres_data=repres_data)
+        indices = entrepRBF(n_non_fraud,probs,repres_data=repres_data)
     else:
         raise ValueError('Method not supported by sampler')
     # print the indices
@@ -241,17 +413,87 @@ def sampler(predicted_data,
     return jnp.concatenate([fraud_indices_sample,indices],axis = 0)
 
 
+def _prefetch_predictions(predict_fn, chunks):
+    '''
+    Yields (offset, probs) for each chunk of the pool. The next chunk is predicted in a
+    background thread while the caller works on the current one (double buffering).
+    '''
+    chunks = iter(chunks)
+    offset = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        chunk = next(chunks, None)
+        future = executor.submit(predict_fn, chunk) if chunk is not None else None
+        while future is not None:
+            next_chunk = next(chunks, None)
+            next_future = executor.submit(predict_fn, next_chunk) if next_chunk is not None else None
+            yield offset, _as_probs(future.result())
+            offset += len(chunk)
+            chunk, future = next_chunk, next_future
+
+def stream_sampler(predict_fn, chunks, K=30, alpha=0.5, threshold_for_fraud=0.8, method='entropy', debug=False, **sampler_args):
+    '''
+    --- Streaming Sampler Function ---
+    Selects the same samples as sampler, but scores the unlabelled pool chunk by chunk.
+    ----------------------------------
+    input:
+    predict_fn: maps a chunk of features to the predicted prob of fraud for each row
+    chunks: iterable of feature chunks covering the unlabelled pool in order
+    K, alpha, threshold_for_fraud, method, debug: as for sampler
+    sampler_args: any other arguments of sampler (X, repres_state, RE_beta, ...)
+
+    For the methods in score_str2fn only a running top-K and the first fraud candidates are
+    kept, so memory stays flat regardless of pool size. The other methods need the whole
+    prob vector, so it is collected and handed to sampler.
+    '''
+    if method not in score_str2fn:
+        probs = jnp.concatenate([probs for _, probs in _prefetch_predictions(predict_fn, chunks)])
+        return sampler(probs, K=K, alpha=alpha, threshold_for_fraud=threshold_for_fraud, method=method, debug=debug, **sampler_args)
+
+    if debug:
+        print("...Streaming Sampling...")
+        print("Fraud/Sample ratio:", alpha)
+        print("Method: ", method)
+    n_fraud = int(K*alpha)
+    n_non_fraud = K - n_fraud
+    score_fn = score_str2fn[method]
+
+    fraud_indices = []
+    n_fraud_found = 0
+    best_scores = jnp.zeros(0, dtype=jnp.float32)
+    best_indices = jnp.zeros(0, dtype=jnp.int32)
+    for offset, probs in _prefetch_predictions(predict_fn, chunks):
+        # fraud cases are taken in pool order, so stop looking once we have enough
+        if n_fraud_found < n_fraud:
+            found = jnp.where(probs > threshold_for_fraud)[0][:n_fraud - n_fraud_found] + offset
+            fraud_indices.append(found)
+            n_fraud_found += len(found)
+
+        # merge the chunk into the running top-K; the running candidates come first and have
+        # lower indices, so ties are still broken towards the lower index
+        scores = jnp.concatenate([best_scores, score_fn(probs).astype(jnp.float32)])
+        indices = jnp.concatenate([best_indices, jnp.arange(len(probs), dtype=jnp.int32) + offset])
+        keep = top_k(scores, n_non_fraud)
+        best_scores, best_indices = scores[keep], indices[keep]
+
+    fraud_indices_sample = jnp.concatenate([jnp.zeros(0, dtype=jnp.int32), *fraud_indices]).astype(jnp.int32)
+    if debug:
+        print(f"Fraud indices: \n {fraud_indices_sample}")
+        print(f"Uncertainty indices: \n {best_indices}")
+
+    return jnp.concatenate([fraud_indices_sample, best_indices], axis=0)
+
 
 #Compute the representativeness of the unlabelled data for RBF, euclidean distance and beta
 '''
 
 
-predicted_data = jnp.array([[1, 2, 3, 4, 0.5],
-                            [5, 6, 7, 8, 0.2],
-                            [9, 10, 11, 12, 0.7],
-                            [13, 14, 15, 16, 0.9]])
+X = jnp.array([[1, 2, 3, 4],
+               [5, 6, 7, 8],
+               [9, 10, 11, 12],
+               [13, 14, 15, 16]])
+probs = jnp.array([0.5, 0.2, 0.7, 0.9])
 '''
 
-#repres_RBF = representativeness_rbf(predicted_data[:,1:-2], sigma=0.5, beta=1)
-#repres_RE = representativeness_reciprocal_euclidean(predicted_data[:,1:-2], beta=1)
+#repres_RBF = representativeness_rbf(X, sigma=0.5, beta=1)
+#repres_RE = representativeness_re(X, beta=1)
 
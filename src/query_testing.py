@@ -15,19 +15,18 @@ y_labelled = y[:100]
 model = LogisticRegression()
 model.fit(X_labelled, y_labelled)
 
-# Define a predict method for the model that returns (x, y, y_hat)
+# Predicted prob of the positive class for each sample
 def predict(data):
-    y_hat = model.predict_proba(data)[:, 1]
-    return np.hstack((data, y_hat.reshape(-1, 1)))
+    return model.predict_proba(data)[:, 1]
 
-predicted_data = predict(X)
+probs = predict(X)
 
-#repres_RBF = query.representativeness_re(predicted_data[:,0:-1], beta=2)
+#repres_RBF = query.representativeness_re(X, beta=2)
 
 # Replace the model's predict method with our custom one
 
 
-selected_indices = query.sampler(predicted_data, K= 50, alpha = 0, method = 'entrepRE',RE_beta= 0)
+selected_indices = query.sampler(probs, X=X, K= 50, alpha = 0, method = 'entrepRE',RE_beta= 0)
 
 print(selected_indices)
 # Get the selected samples
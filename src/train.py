@@ -1,10 +1,9 @@
 from datasets import Dataset
-import jax
 import numpy as np
 import xgboost as xgb
 from utils import get_data, get_X_y, get_X_y_labelled
-from query import sampler
-import jax.numpy as jnp
+from query import stream_sampler, RepresentativenessState
+from pool import LabelPool
 
 def pretrain(model, X:np.ndarray, y:np.ndarray, X_test:np.ndarray, y_test:np.ndarray):
     ds = Dataset.from_dict({"X": X, "y": y})
@@ -17,8 +16,15 @@ def pretrain(model, X:np.ndarray, y:np.ndarray, X_test:np.ndarray, y_test:np.nda
     
     return model.get_metrics()
 
+def predict_probs(model, X:np.ndarray):
+    '''Predicted prob of fraud for each row of X.'''
+    if model.__class__.__name__ == "XGBWrapper":
+        return model.predict_proba(X)
+    else:
+        return model.predict(X)
+
 # Train model
-def train(model, X:np.ndarray, y:np.ndarray, X_test:np.ndarray, y_test:np.ndarray, X_unlabelled:np.ndarray = None, y_unlabelled:np.ndarray = None, num_epochs=20, full_train_every=10, update_ratio=0.1, batch_size='max', query_method='', query_alpha=0.5, query_K=10, query_args={}):
+def train(model, X:np.ndarray, y:np.ndarray, X_test:np.ndarray, y_test:np.ndarray, X_unlabelled:np.ndarray = None, y_unlabelled:np.ndarray = None, num_epochs=20, full_train_every=10, update_ratio=0.1, batch_size='max', query_method='', query_alpha=0.5, query_K=10, query_args={}, query_chunk_size=2**16):
     if query_args == '':
         query_args = {}
     # Separate data into labelled and unlabelled
@@ -36,6 +42,16 @@ def train(model, X:np.ndarray, y:np.ndarray, X_test:np.ndarray, y_test:np.ndarra
 
         # ds_unlabelled = Dataset.from_dict({"X": X_unlabelled, "y": y_unlabelled})
 
+        # labelled and unlabelled rows share one feature matrix, querying only flips membership
+        pool = LabelPool.from_split(X, y, X_unlabelled, y_unlabelled)
+        del X_unlabelled, y_unlabelled
+
+    # keep running representativeness sums rather than recomputing them over the whole pool every epoch
+    repres_state = None
+    if query_method in ['entrepRE', 'entrepRBF'] and query_args.get('repres_approx') is None:
+        repres_args = {k: query_args[k] for k in ['RE_beta', 'RBF_sigma', 'RBF_beta'] if k in query_args}
+        repres_state = RepresentativenessState(pool.unlabelled()[0], method=query_method, **repres_args)
+
     next_X = X
     next_y = y
 
@@ -50,8 +66,7 @@ def train(model, X:np.ndarray, y:np.ndarray, X_test:np.ndarray, y_test:np.ndarra
         # ds.shuffle(seed=epoch)
 
         if (epoch % full_train_every == 0) and (full_train_every != -1):
-            next_X = X
-            next_y = y
+            next_X, next_y = (X, y) if query_method == '' else pool.labelled()
         
         #shuffle X and y
         perm = np.random.permutation(len(next_X))
@@ -76,45 +91,29 @@ def train(model, X:np.ndarray, y:np.ndarray, X_test:np.ndarray, y_test:np.ndarra
 
         # select some unlabelled data to label
         if query_method != '':
-            # predict on unlabelled data by batching
-            predicted = []
-            # for batch_num, batch in enumerate(ds_unlabelled.iter(batch_size=10*batch_size)):
-            for batch_num in range(0, len(X_unlabelled), 10*batch_size):
-                # print(f"Predicting on batch {batch_num//(10*batch_size)}")
-                batch = {"X": X_unlabelled[batch_num:batch_num+10*batch_size]}
-
-                if model.__class__.__name__ == "XGBWrapper":
-                    logits = model.model.predict_proba(batch['X'])
-                else:
-                    logits = jax.nn.sigmoid(model.predict(batch['X']))
-                
-                predicted.append(logits)
-
-            predicted = jnp.concatenate(predicted)
-            
-            query_idx = sampler(predicted, method=query_method, K=query_K, alpha=query_alpha, **query_args)
+            # score the unlabelled data chunk by chunk, keeping only the candidates for the query
+            # (the full unlabelled features are only gathered for representativeness without a running state)
+            X_unlabelled = pool.unlabelled()[0] if query_method in ['entrepRE', 'entrepRBF'] and repres_state is None else None
+            # 'centropy' is a ground truth benchmark, it reads the true labels of the unlabelled pool
+            y_true = pool.y[pool.unlabelled_idx()] if query_method == 'centropy' else None
+            query_idx = stream_sampler(lambda X_chunk: predict_probs(model, X_chunk), pool.iter_unlabelled(query_chunk_size), X=X_unlabelled, method=query_method, K=query_K, alpha=query_alpha, repres_state=repres_state, y_true=y_true, **query_args)
             # breakpoint() 
-            newly_labelled_X = X_unlabelled[query_idx]
-            newly_labelled_y = y_unlabelled[query_idx]
 
-            prev_X = X
-            prev_y = y
-            
-            # update the labelled data for the next iteration
-            idx = np.random.randint(prev_X.shape[0], size=int(X_train.shape[0]*(1-update_ratio)))
+            prev_idx = pool.labelled_idx
 
-            next_X = np.concatenate((newly_labelled_X, prev_X[idx, :]), axis=0)
-            next_y = np.concatenate((newly_labelled_y, prev_y[idx]), axis=0)
+            # move the queried rows into the labelled set
+            newly_labelled_idx = pool.label(query_idx)
+            if repres_state is not None:
+                repres_state.remove(query_idx)
 
-            # update total collection of labelled data
-            X = np.concatenate([X, X_unlabelled[query_idx]])
-            y = np.concatenate([y, y_unlabelled[query_idx]])
-            
-            # remove newly labelled data from unlabelled data
-            X_unlabelled = np.delete(X_unlabelled, query_idx, axis=0)
-            y_unlabelled = np.delete(y_unlabelled, query_idx, axis=0)
+            # update the labelled data for the next iteration
+            idx = np.random.randint(len(prev_idx), size=int(X_train.shape[0]*(1-update_ratio)))
+            next_idx = np.concatenate((newly_labelled_idx, prev_idx[idx]), axis=0)
+
+            next_X = pool.X[next_idx]
+            next_y = pool.y[next_idx]
 
-            # print(f"Labelled size: {len(X)}, Unlabelled size: {len(X_unlabelled)}")
+            # print(f"Labelled size: {pool.n_labelled}, Unlabelled size: {pool.n_unlabelled}")
 
 
             # X_labelled = np.concatenate([ds['X'], ds_unlabelled['X'][query_idx]])
@@ -1,20 +1,223 @@
 import pandas as pd
-from clean_data import normalize
+import numpy as np
+from clean_data import Normalizer
 import os
+import json
+import fcntl
 
-def get_data(normalize_data=False, harry=False):
+SPLITS = ['train', 'test', 'validate']
+LABEL_COLUMNS = ['fraud_bool', 'fraud_masked']
+CACHE_DIR = 'cache'
+VARIANTS_FILE = 'variants.npz'
+
+def get_data_dir(harry=False):
     harry_str = '/harry' if harry else ''
-    train = pd.read_csv(f'../data{harry_str}/train.csv')
-    test = pd.read_csv(f'../data{harry_str}/test.csv')
-    validate = pd.read_csv(f'../data{harry_str}/validate.csv')
+    return f'../data{harry_str}'
+
+def get_data(normalize_data=False, harry=False, use_cache=True, variant=None):
+    '''
+    variant: key of a label variant (see preprocess.write_label_variants) whose masked labels
+             replace the fraud_masked the splits were written with; needs the binary cache
+    '''
+    data_dir = get_data_dir(harry)
+
+    if use_cache:
+        # binary cache is normally written by preprocess.py, build it from the csvs if it is missing
+        if not has_cache(data_dir):
+            build_cache(data_dir)
+        train, test, validate = (cache_to_frame(*read_cache(data_dir, split, variant=variant)) for split in SPLITS)
+    elif variant is not None:
+        raise ValueError("Label variants are stored alongside the binary cache, use_cache must be True.")
+    else:
+        train = pd.read_csv(f'{data_dir}/train.csv')
+        test = pd.read_csv(f'{data_dir}/test.csv')
+        validate = pd.read_csv(f'{data_dir}/validate.csv')
     
     if normalize_data:
-        train = normalize(train)
-        test = normalize(test)
-        validate = normalize(validate)
+        # statistics come from the training split only, and are kept for transforming new data
+        normalizer = Normalizer().fit(train)
+        if use_cache:
+            normalizer.save(os.path.join(data_dir, CACHE_DIR, 'normalizer.json'))
+        train = normalizer.transform(train)
+        test = normalizer.transform(test)
+        validate = normalizer.transform(validate)
 
     return train, test, validate
 
+def build_cache(data_dir):
+    '''
+    Builds the binary cache from the split csvs, unless it is already up to date.
+    Grid jobs sharing a data dir all find a missing (or stale) cache at once, so the build holds a
+    lock: the first job builds it, the others wait and then find it complete.
+    '''
+    os.makedirs(os.path.join(data_dir, CACHE_DIR), exist_ok=True)
+    with open(os.path.join(data_dir, CACHE_DIR, 'build.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not has_cache(data_dir):
+            for split in SPLITS:
+                write_cache(pd.read_csv(f'{data_dir}/{split}.csv'), data_dir, split)
+
+def _cache_path(data_dir, split, name):
+    return os.path.join(data_dir, CACHE_DIR, split, name)
+
+def _source_stat(data_dir, split):
+    '''(mtime_ns, size) of the split's csv, or None if there is no csv.'''
+    path = os.path.join(data_dir, f'{split}.csv')
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def has_cache(data_dir):
+    '''
+    Whether every split has a complete cache that is not older than its csv. A cache records the
+    csv it was built next to (see finish_cache); if that csv has since been rewritten, e.g. by
+    re-running preprocess.py with write_csv, the cache is stale and has to be rebuilt.
+    '''
+    for split in SPLITS:
+        if not os.path.exists(_cache_path(data_dir, split, 'columns.json')):
+            return False
+
+        source = _source_stat(data_dir, split)
+        if source is None:
+            # cache-only data dir (preprocess.py without write_csv)
+            continue
+        source_path = _cache_path(data_dir, split, 'source.json')
+        if not os.path.exists(source_path):
+            return False
+        with open(source_path, 'r') as f:
+            if json.load(f) != source:
+                return False
+    return True
+
+def open_cache(data_dir, split, n_rows, columns, labels=LABEL_COLUMNS):
+    '''
+    Creates the memory-mapped .npy files of a cache split, to be filled in by the caller.
+    Returns a dict of the arrays ('features' and each label), call finish_cache once they are filled.
+    Files of an earlier cache are unlinked rather than truncated, so processes still memory-mapping
+    them keep reading the old data, and the split counts as incomplete until finish_cache.
+    '''
+    os.makedirs(os.path.dirname(_cache_path(data_dir, split, '')), exist_ok=True)
+    if os.path.exists(_cache_path(data_dir, split, 'columns.json')):
+        os.remove(_cache_path(data_dir, split, 'columns.json'))
+
+    def create(name, shape):
+        path = _cache_path(data_dir, split, name)
+        if os.path.exists(path):
+            os.remove(path)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+
+    arrays = {'features': create('features.npy', (n_rows, len(columns)))}
+    for label in labels:
+        arrays[label] = create(f'{label}.npy', (n_rows,))
+    return arrays
+
+def finish_cache(data_dir, split, arrays, columns, rows=None):
+    '''
+    Flushes the arrays of open_cache and marks the split complete. Any csv of the split must already be written.
+    rows: positions of the split's rows in the full (preprocessed) dataset, needed to add label variants later.
+          Leave it None when they are not known (e.g. a cache built from the split csvs alone)
+    '''
+    for array in arrays.values():
+        array.flush()
+    rows_path = _cache_path(data_dir, split, 'rows.npy')
+    if rows is not None:
+        np.save(rows_path, np.asarray(rows, dtype=np.int64))
+    elif os.path.exists(rows_path):
+        # left by an earlier cache of different rows
+        os.remove(rows_path)
+    # masks of an earlier cache refer to different rows
+    if os.path.exists(_cache_path(data_dir, split, VARIANTS_FILE)):
+        os.remove(_cache_path(data_dir, split, VARIANTS_FILE))
+    # the csv this cache corresponds to (if any), so has_cache can tell when the csv changes
+    with open(_cache_path(data_dir, split, 'source.json'), 'w') as f:
+        json.dump(_source_stat(data_dir, split), f)
+    # written last (and swapped in whole), so its presence means the split is complete
+    tmp_path = _cache_path(data_dir, split, 'columns.tmp.json')
+    with open(tmp_path, 'w') as f:
+        json.dump(columns, f)
+    os.replace(tmp_path, _cache_path(data_dir, split, 'columns.json'))
+
+def write_cache(df, data_dir, split, rows=None, chunk_size=2**16):
+    '''
+    Writes a split as .npy arrays that can be memory-mapped by read_cache:
+    a float32 feature matrix, the fraud_bool and fraud_masked label vectors
+    (float32, NaN where masked) and the feature column names.
+
+    rows: optional positions of the rows of df to write (in that order). Rows are gathered
+          chunk_size at a time straight into the memory-mapped output, so a split never needs
+          its own in-memory copy of df. Only when given (df is then the full dataset) are they
+          recorded for label variants.
+    '''
+    columns = [c for c in df.columns if c not in LABEL_COLUMNS]
+    labels = [label for label in LABEL_COLUMNS if label in df.columns]
+    source_rows = rows
+    rows = np.arange(len(df)) if rows is None else np.asarray(rows)
+    arrays = open_cache(data_dir, split, len(rows), columns, labels=labels)
+
+    column_values = [df[c].to_numpy() for c in columns]
+    for i in range(0, len(rows), chunk_size):
+        chunk_rows = rows[i:i+chunk_size]
+        for j, values in enumerate(column_values):
+            arrays['features'][i:i+len(chunk_rows), j] = values[chunk_rows]
+
+    for label in labels:
+        arrays[label][:] = df[label].to_numpy(dtype=np.float32)[rows]
+
+    finish_cache(data_dir, split, arrays, columns, rows=source_rows)
+
+def read_cache(data_dir, split, variant=None):
+    '''
+    Loads a split written by write_cache without copying it into memory.
+    Returns (features, fraud_bool, fraud_masked, columns), a label is None if it was not written.
+    With variant, fraud_masked comes from that label variant instead (see read_variant_mask).
+    '''
+    with open(_cache_path(data_dir, split, 'columns.json'), 'r') as f:
+        columns = json.load(f)
+    features = np.load(_cache_path(data_dir, split, 'features.npy'), mmap_mode='r')
+    fraud_bool, fraud_masked = (np.load(path, mmap_mode='r') if os.path.exists(path) else None
+                                for path in (_cache_path(data_dir, split, f'{label}.npy') for label in LABEL_COLUMNS))
+    if variant is not None:
+        keep = read_variant_mask(data_dir, split, variant, len(fraud_bool))
+        fraud_masked = np.where(keep, fraud_bool, np.nan).astype(np.float32)
+    return features, fraud_bool, fraud_masked, columns
+
+def read_rows(data_dir, split):
+    '''Positions of a cached split's rows in the full dataset, as recorded by write_cache/finish_cache.'''
+    path = _cache_path(data_dir, split, 'rows.npy')
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found (a cache built from the csvs does not know where its rows came from), "
+                                "rerun preprocess.py to write the cache with label variants.")
+    return np.load(path)
+
+def write_variant_masks(data_dir, split, masks):
+    '''
+    Adds label variants to a cached split: masks maps a variant key to a boolean mask (over the
+    split's rows) of the labels that are kept. Stored bit-packed in the split's variants.npz.
+    '''
+    path = _cache_path(data_dir, split, VARIANTS_FILE)
+    stored = dict(np.load(path)) if os.path.exists(path) else {}
+    stored.update({key: np.packbits(keep) for key, keep in masks.items()})
+    # swapped in whole, so readers never see a partially written file
+    tmp_path = _cache_path(data_dir, split, 'variants.tmp.npz')
+    np.savez(tmp_path, **stored)
+    os.replace(tmp_path, path)
+
+def read_variant_mask(data_dir, split, key, n_rows):
+    '''Boolean mask of the kept labels of a cached split under the label variant key.'''
+    path = _cache_path(data_dir, split, VARIANTS_FILE)
+    masks = np.load(path) if os.path.exists(path) else {}
+    if key not in masks:
+        raise KeyError(f"No label variant {key} for the {split} split, add it with preprocess.write_label_variants.")
+    return np.unpackbits(masks[key], count=n_rows).astype(bool)
+
+def cache_to_frame(features, fraud_bool, fraud_masked, columns):
+    '''Wraps cached arrays in a DataFrame laid out like the csvs (no copy of the features).'''
+    df = pd.DataFrame(features, columns=columns, copy=False)
+    df.insert(0, 'fraud_bool', fraud_bool)
+    df['fraud_masked'] = fraud_masked
+    return df
+
 def get_X_y(df, true_labels=False, prop=0.5):
     y = df['fraud_bool' if true_labels else 'fraud_masked']
     X = df.drop(['fraud_bool', 'fraud_masked'], axis=1)
@@ -45,12 +248,15 @@ def get_X_y_unlabelled(df):
 
     return X, y
 
-def check_preprocessed():
-    if not os.path.exists('../data/train.csv'):
+def check_preprocessed(harry=False):
+    data_dir = get_data_dir(harry)
+    if has_cache(data_dir):
+        return True
+    elif not os.path.exists(f'{data_dir}/train.csv'):
         raise FileNotFoundError("Data not found. Please run preprocess.py to preprocess the data.")
-    elif not os.path.exists('../data/test.csv'):
+    elif not os.path.exists(f'{data_dir}/test.csv'):
         raise FileNotFoundError("Data not found. Please run preprocess.py to preprocess the data.")
-    elif not os.path.exists('../data/validate.csv'):
+    elif not os.path.exists(f'{data_dir}/validate.csv'):
         raise FileNotFoundError("Data not found. Please run preprocess.py to preprocess the data.")
     else:
-        return True
\ No newline at end of file
+        return True
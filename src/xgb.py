@@ -1,4 +1,10 @@
+import os
+import time
+import tempfile
+import hashlib
+from collections import OrderedDict
 from functools import partial
+import xgboost as xgb
 from xgboost.sklearn import XGBClassifier
 import numpy as np
 import jax
@@ -7,10 +13,98 @@ from typing import Callable
 from optax.losses import sigmoid_binary_cross_entropy
 from metric import MetricStore
 
+def _content_key(*arrays):
+    '''Hash of the arrays' shapes, dtypes and contents, used to recognise data that already has a DMatrix.'''
+    h = hashlib.blake2b(digest_size=16)
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.shape, a.dtype.str)).encode())
+        h.update(a.data)
+    return h.hexdigest()
+
+def logloss(y_true, y_probs, eps=1e-16):
+    '''Binary log loss, clipped like xgboost's logloss metric.'''
+    y_probs = np.clip(y_probs, eps, 1 - eps)
+    return float(-np.mean(y_true*np.log(y_probs) + (1 - y_true)*np.log(1 - y_probs)))
+
+update_modes = ['append', 'fixed', 'refresh', 'cap']
+sampling_methods = ['uniform', 'gradient_based']
+
+class ChunkIter(xgb.DataIter):
+    '''
+    Feeds X, y to xgboost chunk by chunk, for external-memory training matrices.
+    X and y can be memmaps (e.g. the utils cache), only one chunk is ever read into memory.
+    xgboost writes its pages to cache_dir, which the caller owns and removes when done.
+    '''
+    def __init__(self, X, y, cache_dir, chunk_size=2**16):
+        self.X = X
+        self.y = y
+        self.chunk_size = chunk_size
+        self._start = 0
+        super().__init__(cache_prefix=os.path.join(cache_dir, 'cache'))
+
+    def next(self, input_data):
+        if self._start >= len(self.X):
+            return False
+        end = self._start + self.chunk_size
+        input_data(data=np.asarray(self.X[self._start:end]), label=np.asarray(self.y[self._start:end]))
+        self._start = end
+        return True
+
+    def reset(self):
+        self._start = 0
+
 # Wrapper for the xgb model to make it easily swappable with the neural network model in the training loop
+
 class XGBWrapper:
-    def __init__(self, model):
+    def __init__(self, model, dmatrix_cache_size=4, update_mode='append', update_trees=10, max_trees=1000,
+                 external_memory=False, external_memory_chunk_size=2**16):
+        '''
+        model: XGBClassifier holding the hyperparameters; training itself goes through xgb.train
+               on (Quantile)DMatrix objects that are cached across calls
+        dmatrix_cache_size: number of DMatrix objects kept, least recently used are dropped first
+        update_mode: what update does with the new data
+            'append':  boost n_estimators more trees (the ensemble grows by n_estimators every update)
+            'fixed':   boost update_trees more trees
+            'refresh': keep the trees, only refit their leaf values on the new data
+                       (process_type=update, updater=refresh), so the ensemble size never changes
+            'cap':     boost update_trees more trees, but retrain from scratch (n_estimators trees)
+                       on the new data once the ensemble would exceed max_trees
+        external_memory: build training matrices from a ChunkIter (ExtMemQuantileDMatrix), so xgboost
+                         pages the quantized data through disk instead of holding it all in memory.
+                         The pages go to a temporary directory that is deleted after every fit/update,
+                         so in this mode training matrices are not kept in the DMatrix cache
+        external_memory_chunk_size: rows per chunk handed to xgboost in external memory mode
+        '''
+        if update_mode not in update_modes:
+            raise ValueError(f"update_mode must be one of {update_modes}, got {update_mode}.")
+
         self.model = model
+        self.params = {k: v for k, v in model.get_xgb_params().items() if v is not None}
+        # the eval logloss is computed in _train from predictions it captures, so xgboost needn't compute its own
+        self.params.pop('eval_metric', None)
+        self.params['disable_default_eval_metric'] = True
+        self.n_estimators = model.n_estimators
+        self.booster = None
+        self._evals_result = {}
+
+        self.update_mode = update_mode
+        self.update_trees = update_trees
+        self.max_trees = max_trees
+
+        # one entry per predict_proba call: fit/update iteration, ensemble size, rows scored and seconds taken
+        self.iteration = 0
+        self.predict_latency = []
+
+        # (kind, content hash) -> DMatrix, so the static test set (and any repeated training set)
+        # is only converted/quantized once per run
+        self.dmatrix_cache_size = dmatrix_cache_size
+        self._dmatrix_cache = OrderedDict()
+        self.external_memory = external_memory
+        self.external_memory_chunk_size = external_memory_chunk_size
+        # page files of the external-memory training matrix, removed after each training
+        self._page_dir = None
+
         # self. all_metrics = {
         #     'loss': {'training': [], 'validation': []},
         #     'auc': {'training': [], 'validation': []},
@@ -20,48 +114,148 @@ class XGBWrapper:
         self.metric_store = MetricStore()
         self.logged_loss = False
 
-    def update(self, X, y, eval_set=None):
-        """ Update the model with new data."""
-        self.logged_loss = False
+    def _dmatrix(self, X, y, quantile=False):
+        '''Cached QuantileDMatrix (for training) or DMatrix (for evaluation) of X, y.'''
+        key = ('quantile' if quantile else 'dmatrix', _content_key(X, y))
+        if key in self._dmatrix_cache:
+            self._dmatrix_cache.move_to_end(key)
+            return self._dmatrix_cache[key]
 
-        updated_model = self.model.fit(X, y, eval_set=eval_set, xgb_model=self.model, verbose=False)
+        # build with the same number of threads as training, so grid points sharing a node don't oversubscribe it
+        nthread = self.params.get('n_jobs')
+        if quantile and self.external_memory:
+            if self._page_dir is None:
+                self._page_dir = tempfile.TemporaryDirectory(prefix='xgb_')
+            dmatrix = xgb.ExtMemQuantileDMatrix(ChunkIter(X, y, self._page_dir.name, chunk_size=self.external_memory_chunk_size),
+                                                max_bin=self.params.get('max_bin'), nthread=nthread)
+        elif quantile:
+            dmatrix = xgb.QuantileDMatrix(X, label=y, max_bin=self.params.get('max_bin'), nthread=nthread)
+        else:
+            dmatrix = xgb.DMatrix(X, label=y, nthread=nthread)
 
-        eval_set_names = ['training', 'validation', 'test']
+        self._dmatrix_cache[key] = dmatrix
+        if len(self._dmatrix_cache) > self.dmatrix_cache_size:
+            self._dmatrix_cache.popitem(last=False)
+        return dmatrix
 
+    def _remove_pages(self):
+        '''Drops the external-memory training matrices and deletes the directory of their page files.'''
+        for key in [key for key in self._dmatrix_cache if key[0] == 'quantile']:
+            del self._dmatrix_cache[key]
+        self._page_dir.cleanup()
+        self._page_dir = None
+
+    def _train(self, X, y, eval_set=None, xgb_model=None, num_boost_round=None, params=None, quantile=True):
+        '''
+        Boosts num_boost_round (default n_estimators) rounds on X, y (on top of xgb_model if given),
+        then scores the eval sets. params are added to the model's parameters for this call only.
+        quantile: train on a QuantileDMatrix (not supported by every updater, e.g. refresh)
+        '''
+        X, y = np.asarray(X), np.asarray(y)
+        dtrain = self._dmatrix(X, y, quantile=quantile)
+
+        evals = []
         if eval_set is not None:
             for i, (eval_X, eval_y) in enumerate(eval_set):
-                y_probs = updated_model.predict_proba(eval_X)[:, 1]
+                # always a plain DMatrix of the raw features, even for the training batch: dtrain is
+                # binned with this batch's cut points, which misplaces trees boosted on earlier batches
+                evals.append((self._dmatrix(np.asarray(eval_X), np.asarray(eval_y)), f'validation_{i}'))
+
+        # xgboost hands every round's predictions on each eval set to the custom metric; keeping the
+        # latest ones gives the final predictions for the metrics below without predicting again.
+        # Only valid because every eval matrix above holds the raw features (see the comment there)
+        labels = {id(dmatrix): dmatrix.get_label() for dmatrix, _ in evals}
+        captured = {}
+
+        def capture_logloss(y_probs, dmatrix):
+            captured[id(dmatrix)] = y_probs
+            return 'logloss', logloss(labels[id(dmatrix)], y_probs)
+
+        evals_result = {}
+        try:
+            self.booster = xgb.train({**self.params, **(params or {})}, dtrain, num_boost_round=num_boost_round or self.n_estimators,
+                                     evals=evals, evals_result=evals_result, custom_metric=capture_logloss,
+                                     xgb_model=xgb_model, verbose_eval=False)
+        finally:
+            if self._page_dir is not None:
+                # the matrix deletes its own page files once released, the directory has to outlive it
+                del dtrain
+                self._remove_pages()
+        self._evals_result = evals_result
+        self.iteration += 1
 
-                self.metric_store.calculate_metrics(eval_y, y_probs, eval_set_names[i])
+        eval_set_names = ['training', 'validation', 'test']
+
+        for i, (dmatrix, _) in enumerate(evals):
+            self.metric_store.calculate_metrics(labels[id(dmatrix)], captured[id(dmatrix)], eval_set_names[i])
+
+        return self.booster
+
+    def update(self, X, y, eval_set=None):
+        """ Update the model with new data."""
+        self.logged_loss = False
+
+        if self.booster is None:
+            updated_model = self._train(X, y, eval_set=eval_set)
+        elif self.update_mode == 'append':
+            updated_model = self._train(X, y, eval_set=eval_set, xgb_model=self.booster)
+        elif self.update_mode == 'fixed':
+            updated_model = self._train(X, y, eval_set=eval_set, xgb_model=self.booster, num_boost_round=self.update_trees)
+        elif self.update_mode == 'refresh':
+            # one round per existing tree, each refitting that tree's leaves
+            refresh_params = {'process_type': 'update', 'updater': 'refresh', 'refresh_leaf': True}
+            updated_model = self._train(X, y, eval_set=eval_set, xgb_model=self.booster,
+                                        num_boost_round=self.n_trees, params=refresh_params, quantile=False)
+        elif self.n_trees + self.update_trees > self.max_trees:  # 'cap'
+            updated_model = self._train(X, y, eval_set=eval_set)
+        else:
+            updated_model = self._train(X, y, eval_set=eval_set, xgb_model=self.booster, num_boost_round=self.update_trees)
 
         self.get_metrics()
         return updated_model
 
+    @property
+    def n_trees(self):
+        """ Number of boosting rounds in the current ensemble."""
+        return 0 if self.booster is None else self.booster.num_boosted_rounds()
+
+    def predict_proba(self, X):
+        """ Predicted probability of fraud for each row of X."""
+        start = time.perf_counter()
+        y_probs = self.booster.inplace_predict(np.asarray(X))
+        self.predict_latency.append({'iteration': self.iteration, 'n_trees': self.n_trees,
+                                     'rows': len(y_probs), 'time': time.perf_counter() - start})
+        return y_probs
+
+    def latency_per_iteration(self):
+        """ Seconds per 1000 predicted rows for each fit/update iteration, from predict_latency."""
+        totals = {}
+        for record in self.predict_latency:
+            rows, seconds = totals.get(record['iteration'], (0, 0.0))
+            totals[record['iteration']] = (rows + record['rows'], seconds + record['time'])
+        return {iteration: 1000*seconds/max(rows, 1) for iteration, (rows, seconds) in sorted(totals.items())}
+
     def predict(self, X):
         """ Predict on the given data."""
-        return self.model.predict(X)
+        return (self.predict_proba(X) > 0.5).astype(int)
     
     def fit(self, X, y, eval_set=None):
         """ Fit the model on the given data."""
         self.logged_loss = False
 
-        fitted_model = self.model.fit(X, y, eval_set=eval_set, verbose=False)
+        fitted_model = self._train(X, y, eval_set=eval_set)
 
-        eval_set_names = ['training', 'validation', 'test']
-
-        if eval_set is not None:
-            for i, (eval_X, eval_y) in enumerate(eval_set):
-                y_probs = fitted_model.predict_proba(eval_X)[:, 1]
-
-                self.metric_store.calculate_metrics(eval_y, y_probs, eval_set_names[i])
-
-            # self.get_metrics()
+        # self.get_metrics()
         return fitted_model
+
+    def evals_result(self):
+        """ Per-round eval metrics of the last fit/update, as in XGBClassifier.evals_result."""
+        return self._evals_result
     
     def get_metrics(self, eval_set=None, log_final=True):
         """ Get the metrics from the model."""
         if not self.logged_loss or log_final:
-            results = self.model.evals_result()
+            results = self.evals_result()
 
             # self.metric_store.log({'loss': {'training':   np.log(np.mean(np.exp(results['validation_0']['logloss'][0]))), 
             #                                 'validation': np.log(np.mean(np.exp(results['validation_1']['logloss'][0])))}})
@@ -106,6 +300,24 @@ class XGBWrapper:
 # ----- Currently not using this -----
 
 # Create xgb model
-def get_xgb(lr=0.1, n_estimators=100, max_depth=2):
-    """ Create an XGBClassifier model with the given learning rate. """
-    return XGBWrapper(XGBClassifier(objective='binary:logistic', n_estimators=n_estimators, max_depth=max_depth, learning_rate=lr, eval_metric=["logloss"]))#, "error", "auc", "aucpr", "pre"]))
\ No newline at end of file
+def get_xgb(lr=0.1, n_estimators=100, max_depth=2, update_mode='append', update_trees=10, max_trees=1000,
+            tree_method='hist', max_bin=256, nthread=None, subsample=1.0, sampling_method='uniform', external_memory=False):
+    """
+    Create an XGBClassifier model with the given learning rate.
+
+    tree_method, max_bin: histogram construction (max_bin trades accuracy for speed and memory)
+    nthread: threads used by this model; defaults to SLURM_CPUS_PER_TASK when set (so each job
+             only uses the cores it was given), otherwise all cores
+    subsample, sampling_method: row subsampling per tree, 'uniform' or 'gradient_based' (rows sampled by
+                                their gradients, so a small subsample still keeps the informative rows)
+    external_memory: see XGBWrapper
+    """
+    if sampling_method not in sampling_methods:
+        raise ValueError(f"sampling_method must be one of {sampling_methods}, got {sampling_method}.")
+
+    if nthread is None and os.environ.get('SLURM_CPUS_PER_TASK'):
+        nthread = int(os.environ['SLURM_CPUS_PER_TASK'])
+
+    return XGBWrapper(XGBClassifier(objective='binary:logistic', n_estimators=n_estimators, max_depth=max_depth, learning_rate=lr, eval_metric=["logloss"],
+                                    tree_method=tree_method, max_bin=max_bin, n_jobs=nthread, subsample=subsample, sampling_method=sampling_method),
+                      update_mode=update_mode, update_trees=update_trees, max_trees=max_trees, external_memory=external_memory)#, "error", "auc", "aucpr", "pre"]))
\ No newline at end of file
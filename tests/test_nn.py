@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from nn import get_nn, DeviceDataset, eval_epoch
+
+
+def make_data(n, seed):
+    rng = np.random.RandomState(seed)
+    X = rng.randn(n, 8).astype(np.float32)
+    y = (X[:, 0] + rng.randn(n) > 1).astype(np.float32)
+    return X, y
+
+
+def test_only_update_data_is_bucketed():
+    # 5 batches of 64: the static sets keep 5, the growing training set of update is padded to 8
+    X, y = make_data(300, 0)
+    X_test, y_test = make_data(300, 1)
+    model = get_nn(num_epochs=1, num_update_epochs=1, batch_size=64, MLP_shape='16')
+
+    model.fit(X, y)
+    model.validation((X_test, y_test))
+    assert model.to_device(X, y).X.shape[0] == 5
+    assert model.to_device(X_test, y_test).X.shape[0] == 5
+
+    model.update(X, y)
+    assert model.to_device(X, y, bucket=True).X.shape[0] == 8
+
+
+def test_eval_skips_bucket_padding():
+    X, y = make_data(300, 0)
+    model = get_nn(num_epochs=1, batch_size=64, MLP_shape='16')
+    model.fit(X, y)
+
+    data, bucketed = DeviceDataset(X, y, 64), DeviceDataset(X, y, 64, bucket=True)
+    loss, logits = eval_epoch(model.state, data.X, data.y, data.mask)
+    bucketed_loss, bucketed_logits = eval_epoch(model.state, bucketed.X, bucketed.y, bucketed.mask)
+
+    assert float(bucketed_loss) == pytest.approx(float(loss), rel=1e-6)
+    np.testing.assert_allclose(np.asarray(bucketed_logits)[:300], np.asarray(logits)[:300], rtol=1e-5)
+    # the all-padding batches are never run, so their logits stay zero
+    np.testing.assert_array_equal(np.asarray(bucketed_logits)[5*64:], 0)
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+import utils
+from preprocess import train_test_split, write_label_variants, delabel_mask
+from utils import SPLITS, read_cache, read_rows
+
+
+def make_df(n, seed):
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame(rng.randn(n, 4).astype(np.float32), columns=['a', 'b', 'c', 'd'])
+    df.insert(0, 'fraud_bool', (rng.rand(n) < 0.05).astype(np.int64))
+    df['fraud_masked'] = df['fraud_bool'].astype(np.float32)
+    return df
+
+
+def test_label_variants_match_full_dataset_mask(tmp_path):
+    df = make_df(20000, 0)
+    train_test_split(df, out_dir=str(tmp_path))
+    [key] = write_label_variants(str(tmp_path), [{'labelled_proportion': 0.1, 'labelled_positive_proportion': 0.4}])
+
+    keep = delabel_mask(df['fraud_bool'].to_numpy(), 0.1, 0.4)
+    n_labelled = 0
+    for split in SPLITS:
+        fraud_bool, fraud_masked = read_cache(str(tmp_path), split, variant=key)[1:3]
+        rows = read_rows(str(tmp_path), split)
+        np.testing.assert_array_equal(~np.isnan(fraud_masked), keep[rows])
+        np.testing.assert_array_equal(fraud_bool, df['fraud_bool'].to_numpy()[rows])
+        n_labelled += (~np.isnan(fraud_masked)).sum()
+    assert n_labelled == 2000
+
+
+def test_label_variants_need_rows_of_full_dataset(tmp_path, monkeypatch):
+    # a cache built from the csvs alone only knows positions within each split
+    df = make_df(20000, 0)
+    for split, rows in zip(SPLITS, np.array_split(np.arange(len(df)), 3)):
+        df.iloc[rows].to_csv(tmp_path / f'{split}.csv', index=False)
+    monkeypatch.setattr(utils, 'get_data_dir', lambda harry=False: str(tmp_path))
+    utils.get_data()
+
+    with pytest.raises(FileNotFoundError, match='rows.npy'):
+        write_label_variants(str(tmp_path), [{'labelled_proportion': 0.1, 'labelled_positive_proportion': 0.4}])
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+from query import sampler, stream_sampler
+
+
+def test_centropy_uses_true_labels():
+    rng = np.random.RandomState(0)
+    probs = rng.rand(500).astype(np.float32)
+    y_true = (rng.rand(500) < 0.1).astype(np.float32)
+
+    # with q = 0.1 the cross entropy is largest for the highest predicted probs
+    idx = np.asarray(sampler(probs, K=10, alpha=0.0, method='centropy', y_true=y_true))
+    np.testing.assert_array_equal(np.sort(idx), np.sort(np.argsort(-probs)[:10]))
+
+    chunks = [probs[i:i+128, None] for i in range(0, 500, 128)]
+    streamed = stream_sampler(lambda X_chunk: X_chunk[:, 0], chunks, K=10, alpha=0.0, method='centropy', y_true=y_true)
+    np.testing.assert_array_equal(np.asarray(streamed), idx)
+
+
+def test_centropy_needs_true_labels():
+    with pytest.raises(ValueError, match='y_true'):
+        sampler(np.random.rand(100), K=10, method='centropy')
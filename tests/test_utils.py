@@ -0,0 +1,43 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+import utils
+from utils import SPLITS, build_cache, has_cache, read_cache, write_cache
+
+
+def write_csvs(data_dir, n, seed):
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame(rng.randn(n, 3).astype(np.float32), columns=['a', 'b', 'c'])
+    df.insert(0, 'fraud_bool', (rng.rand(n) < 0.1).astype(np.int64))
+    df['fraud_masked'] = df['fraud_bool'].astype(np.float32)
+    for split, rows in zip(SPLITS, np.array_split(np.arange(n), 3)):
+        df.iloc[rows].to_csv(data_dir / f'{split}.csv', index=False)
+    return df
+
+
+def test_rebuild_leaves_open_mappings_intact(tmp_path):
+    write_csvs(tmp_path, 300, 0)
+    build_cache(str(tmp_path))
+    features = read_cache(str(tmp_path), 'train')[0]
+    before = np.array(features)
+
+    # another job rebuilding the split must not truncate the file under this mapping
+    write_cache(pd.read_csv(tmp_path / 'test.csv'), str(tmp_path), 'train')
+    np.testing.assert_array_equal(features, before)
+    assert not np.array_equal(read_cache(str(tmp_path), 'train')[0], before)
+
+
+def _get_train_features(data_dir):
+    utils.get_data_dir = lambda harry=False: data_dir
+    return np.asarray(utils.get_data()[0][['a', 'b', 'c']])
+
+
+def test_concurrent_builds(tmp_path):
+    df = write_csvs(tmp_path, 3000, 0)
+    with multiprocessing.get_context('spawn').Pool(4) as pool:
+        results = pool.map(_get_train_features, [str(tmp_path)]*4)
+
+    expected = df[['a', 'b', 'c']].to_numpy()[:1000]
+    for features in results:
+        np.testing.assert_array_equal(features, expected)
+    assert has_cache(str(tmp_path))
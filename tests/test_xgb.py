@@ -0,0 +1,82 @@
+import tempfile
+import warnings
+import numpy as np
+import pytest
+from sklearn.metrics import roc_auc_score
+from xgb import get_xgb, logloss
+
+
+def make_data(n, seed):
+    rng = np.random.RandomState(seed)
+    X = rng.randn(n, 10).astype(np.float32)
+    y = (X[:, 0] + X[:, 1]**2 + rng.randn(n) > 1.5).astype(np.float32)
+    return X, y
+
+
+@pytest.mark.parametrize('update_mode', ['append', 'refresh'])
+def test_training_metrics_match_predictions_after_update(update_mode):
+    # coarse bins, so scoring on a matrix quantized with another batch's cut points would show
+    X, y = make_data(4000, 0)
+    X_test, y_test = make_data(2000, 1)
+    model = get_xgb(n_estimators=20, max_depth=4, max_bin=16, update_mode=update_mode)
+
+    model.fit(X, y, eval_set=[(X, y), (X_test, y_test)])
+    X_new, y_new = make_data(1000, 2)
+    model.update(X_new, y_new, eval_set=[(X_new, y_new), (X_test, y_test)])
+
+    metrics = model.get_metrics().metrics
+    for (eval_X, eval_y), name in [((X_new, y_new), 'training'), ((X_test, y_test), 'validation')]:
+        y_probs = model.predict_proba(eval_X)
+        assert metrics['auc'][name][-1] == pytest.approx(roc_auc_score(eval_y, y_probs))
+        assert metrics['tp'][name][-1] == int(((eval_y == 1) & (y_probs >= 0.5)).sum())
+        # evals_result is rounded by xgboost's metric formatting
+        assert metrics['loss'][name][-1] == pytest.approx(logloss(eval_y, y_probs), abs=1e-5)
+
+
+def test_logloss_history_matches_staged_predictions_after_update():
+    # the captured predictions behind every round's logloss must be the model's own, not a re-binned view
+    X, y = make_data(4000, 0)
+    X_test, y_test = make_data(2000, 1)
+    model = get_xgb(n_estimators=10, max_depth=4, max_bin=16, update_mode='append')
+
+    model.fit(X, y, eval_set=[(X, y), (X_test, y_test)])
+    X_new, y_new = make_data(1000, 2)
+    model.update(X_new, y_new, eval_set=[(X_new, y_new), (X_test, y_test)])
+
+    history = model.evals_result()['validation_0']['logloss']
+    assert len(history) == 10
+    for i, loss in enumerate(history):
+        y_probs = model.booster.inplace_predict(X_new, iteration_range=(0, 10 + i + 1))
+        assert loss == pytest.approx(logloss(y_new, y_probs), abs=1e-5)
+
+
+def test_external_memory_pages_removed_after_training(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    X, y = make_data(4000, 0)
+    model = get_xgb(n_estimators=5, max_depth=3, external_memory=True)
+
+    # xgboost warns (through its log callback) when the page files vanish before the matrix is freed
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        model.fit(X, y, eval_set=[(X, y), (X, y)])
+        assert list(tmp_path.iterdir()) == []
+        X_new, y_new = make_data(1000, 2)
+        model.update(X_new, y_new, eval_set=[(X_new, y_new), (X, y)])
+        assert list(tmp_path.iterdir()) == []
+    assert [str(w.message) for w in caught if 'external memory' in str(w.message).lower()] == []
+    assert model.n_trees == 10
+
+
+def test_unknown_sampling_method_rejected():
+    with pytest.raises(ValueError, match='sampling_method'):
+        get_xgb(sampling_method='random')
+
+
+def test_gradient_based_sampling_trains():
+    X, y = make_data(4000, 0)
+    probs = {}
+    for sampling_method in ['uniform', 'gradient_based']:
+        model = get_xgb(n_estimators=10, max_depth=3, subsample=0.1, sampling_method=sampling_method)
+        model.fit(X, y, eval_set=[(X, y), (X, y)])
+        probs[sampling_method] = model.predict_proba(X)
+    assert not np.allclose(probs['uniform'], probs['gradient_based'])